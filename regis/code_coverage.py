@@ -6,9 +6,22 @@ import subprocess
 import re
 import diagnostics
 import shutil
+import json
+import fnmatch
+import hashlib
+import html
+import multiprocessing
+import sys
 import regis.util
 import regis.rex_json
 
+from multiprocessing.pool import ThreadPool
+
+try:
+  import ijson
+except ImportError:
+  ijson = None
+
 html_report_folder = "lcov"
 root_path = regis.util.find_root()
 settings = regis.rex_json.load_file(os.path.join(root_path, regis.util.settingsPathFromRoot))
@@ -22,8 +35,65 @@ def create_index_rawdata(rawdataPath):
     
   output_path = os.path.join(output_folder, f"{Path(rawdataPath).stem}.profdata")
   llvm_profdata_path = required_tools.tool_paths_dict["llvm_profdata_path"]
-  os.system(f"{llvm_profdata_path} merge -sparse {rawdataPath} -o {output_path}")
+  subprocess.run([llvm_profdata_path, "merge", "-sparse", rawdataPath, "-o", output_path])
+
+  return output_path
+
+def __hash_file(path : str):
+  hasher = hashlib.sha1()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+def __get_artifact_cache_filename(profDataPath):
+  return os.path.join(Path(profDataPath).parent, f"{Path(profDataPath).stem}_artifacts.json")
+
+def __load_artifact_cache(profDataPath):
+  """The artifact cache holds the hash of the inputs the indexed file was created from
+  and the reports that have been created from it since"""
+  cache_path = __get_artifact_cache_filename(profDataPath)
+  if not os.path.exists(cache_path) or not os.path.exists(profDataPath):
+    return { "key": None, "reports": [] }
+
+  return regis.rex_json.load_file(cache_path) or { "key": None, "reports": [] }
+
+def merge_rawdata(rawdataPaths : list[str], name : str, programs : list[str] = []):
+  """Merge the raw data of many runs, possibly of different programs, into a single indexed file.
+  If the programs and the raw data are the same as the last time, the indexed file of last time is reused"""
+  log_folder = os.path.join(root_path, settings["intermediate_folder"], settings["logs_folder"])
+  output_folder = os.path.join(log_folder, name)
+  if not os.path.isdir(output_folder):
+    os.makedirs(output_folder)
+
+  output_path = os.path.join(output_folder, f"{name}.profdata")
+
+  # the raw data filenames contain the pid, so only their content is hashed
+  hasher = hashlib.sha1()
+  for file_hash in sorted([__hash_file(program) for program in programs if os.path.exists(program)]):
+    hasher.update(file_hash.encode('utf-8'))
+  hasher.update(b'-')
+  for file_hash in sorted([__hash_file(path) for path in rawdataPaths]):
+    hasher.update(file_hash.encode('utf-8'))
+  key = hasher.hexdigest()
+
+  if __load_artifact_cache(output_path)["key"] == key and os.path.exists(output_path):
+    diagnostics.log_info(f"coverage data of {name} didn't change, reusing {output_path}")
+    return output_path
+
+  # the raw data files are passed through a file, there can be too many of them to fit on the command line
+  input_files_path = os.path.join(output_folder, f"{name}_profraw_files.txt")
+  with open(input_files_path, "w") as f:
+    f.writelines([f"{path}\n" for path in rawdataPaths])
+
+  llvm_profdata_path = required_tools.tool_paths_dict["llvm_profdata_path"]
+  rc = subprocess.run([llvm_profdata_path, "merge", "-sparse", f"-j={os.cpu_count()}", f"--input-files={input_files_path}", "-o", output_path]).returncode
+  if rc != 0:
+    diagnostics.log_err(f"failed to merge coverage raw data into {output_path}")
+    return None
 
+  # a new indexed file invalidates all reports created from the previous one
+  regis.rex_json.save_file(__get_artifact_cache_filename(output_path), { "key": key, "reports": [] })
   return output_path
 
 def get_line_oriented_report_filename(profDataPath):
@@ -36,6 +106,16 @@ def get_file_level_summary_filename(profDataPath):
   stem = Path(profDataPath).stem
   return os.path.join(log_folder, stem, f"{Path(profDataPath).stem}_file.report")
 
+def get_coverage_summary_filename(profDataPath):
+  log_folder = os.path.join(root_path, settings["intermediate_folder"], settings["logs_folder"])
+  stem = Path(profDataPath).stem
+  return os.path.join(log_folder, stem, f"{Path(profDataPath).stem}_summary.json")
+
+def get_diff_lcov_filename(profDataPath):
+  log_folder = os.path.join(root_path, settings["intermediate_folder"], settings["logs_folder"])
+  stem = Path(profDataPath).stem
+  return os.path.join(log_folder, stem, f"{Path(profDataPath).stem}_diff_lcov.info")
+
 def get_lcov_filename(profDataPath):
   log_folder = os.path.join(root_path, settings["intermediate_folder"], settings["logs_folder"])
   stem = Path(profDataPath).stem
@@ -46,45 +126,103 @@ def get_lcov_unmangled_filename(profDataPath):
   stem = Path(profDataPath).stem
   return os.path.join(log_folder, stem, f"{Path(profDataPath).stem}_lcov_unmangled.info")
 
+def __program_args(programPath):
+  """llvm-cov takes the first program as positional argument, other programs are passed with -object"""
+  if isinstance(programPath, str):
+    return [programPath]
+
+  args = [programPath[0]]
+  for program in programPath[1:]:
+    args.extend(["-object", program])
+  return args
+
+def __run_llvm_tool(cmd : list[str], logFilePath : str, writeHeader : bool = True):
+  """Run a coverage tool and save its output to the log file.
+  The output is directly redirected to the file, capturing stdout lines crashes llvm"""
+  if os.path.exists(logFilePath):
+    os.remove(logFilePath)
+
+  with open(logFilePath, "w") as f:
+    if writeHeader:
+      f.write(f"# This file was generated by running the following command:\n")
+      f.write(f"# {' '.join(cmd)}\n")
+      f.flush()
+
+    return subprocess.run(cmd, stdout=f).returncode
+
 def create_line_oriented_report(programPath, profDataPath):
   llvm_cov_path = required_tools.tool_paths_dict["llvm_cov_path"]
   log_file_path = get_line_oriented_report_filename(profDataPath)
-  if os.path.exists(log_file_path):
-    os.remove(log_file_path)
-
-  f = open(log_file_path, "w")
-  cmd = f"{llvm_cov_path} show -format=html {programPath} -instr-profile={profDataPath} >> {log_file_path}"
-  f.write(f"# This file was generated by running the following command:\n")
-  f.write(f"# {cmd}\n")
-  f.close()
-  os.system(cmd) # using >> is a hack to get the logs into a file, capturing stdout lines crashes llvm
-  return log_file_path
+  cmd = [llvm_cov_path, "show", "-format=html", *__program_args(programPath), f"-instr-profile={profDataPath}"]
+  return __run_llvm_tool(cmd, log_file_path)
   
 def create_file_level_summary(programPath, profDataPath):
   llvm_cov_path = required_tools.tool_paths_dict["llvm_cov_path"]
   log_file_path = get_file_level_summary_filename(profDataPath)
-  if os.path.exists(log_file_path):
-    os.remove(log_file_path)
-
-  f = open(log_file_path, "w")
-  cmd = f"{llvm_cov_path} report {programPath} -instr-profile={profDataPath} >> {log_file_path}"
-  f.write(f"# This file was generated by running the following command:\n")
-  f.write(f"# {cmd}\n")
-  f.close()
-  os.system(cmd) # using >> is a hack to get the logs into a file, capturing stdout lines crashes llvm
-  return log_file_path
+  cmd = [llvm_cov_path, "report", *__program_args(programPath), f"-instr-profile={profDataPath}"]
+  return __run_llvm_tool(cmd, log_file_path)
+
+def create_coverage_summary(programPath, profDataPath):
+  llvm_cov_path = required_tools.tool_paths_dict["llvm_cov_path"]
+  log_file_path = get_coverage_summary_filename(profDataPath)
+  cmd = [llvm_cov_path, "export", "-summary-only", "-format=text", *__program_args(programPath), f"-instr-profile={profDataPath}"]
+  return __run_llvm_tool(cmd, log_file_path, writeHeader=False)
 
 def __create_mangled_lcov_info(programPath, profDataPath):
   llvm_cov_path = required_tools.tool_paths_dict["llvm_cov_path"]
   log_file_path = get_lcov_filename(profDataPath)
-  cmd = f"{llvm_cov_path} export -format=lcov {programPath} -instr-profile={profDataPath} >> {log_file_path}"
-  os.system(cmd)
+  cmd = [llvm_cov_path, "export", "-format=lcov", *__program_args(programPath), f"-instr-profile={profDataPath}"]
+  __run_llvm_tool(cmd, log_file_path, writeHeader=False)
   return log_file_path
 
-def __unmangle_function_names(logFilePath, profDataPath):
-  # the lcov info file will have mangled names, unfortunately using -Xdemangler doesn't work so we have to manually parse by undname (on Windows)
-  # this works, but will result in a bit of an invalid .info file as it parsed ',' to get to the next value, and templated functions will use ',' tokens to separate arguments
-  # so we'll parse these .info files ourselves after they're unmangled, changing all ',' to a different token to have a proper html report
+class Demangler():
+  """Demangles symbol names through a single llvm-cxxfilt process that's kept alive for all names.
+  Every name is only demangled once, lcov files contain the same function names many times"""
+  def __init__(self, cxxfiltPath : str):
+    self.proc = subprocess.Popen([cxxfiltPath], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+    self.cache : dict[str, str] = {}
+
+  def demangle(self, name : str):
+    if name not in self.cache:
+      # names of static functions are prefixed with the file they're in
+      prefix = ""
+      mangled_name = name
+      separator = name.rfind(':')
+      if separator != -1 and name[separator+1:].startswith('_Z'):
+        prefix = name[:separator+1]
+        mangled_name = name[separator+1:]
+
+      # llvm-cxxfilt flushes every line it demangles, so we can read the result back immediately
+      self.proc.stdin.write(f"{mangled_name}\n")
+      self.cache[name] = prefix + self.proc.stdout.readline().rstrip('\n')
+
+    return self.cache[name]
+
+  def close(self):
+    self.proc.stdin.close()
+    self.proc.wait()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
+
+def __find_cxxfilt():
+  """llvm-cxxfilt comes with the same llvm installation as llvm-cov, if it's not configured explicitly"""
+  if "llvm_cxxfilt_path" in required_tools.tool_paths_dict:
+    return required_tools.tool_paths_dict["llvm_cxxfilt_path"]
+
+  llvm_cov_path = Path(required_tools.tool_paths_dict["llvm_cov_path"])
+  cxxfilt_path = os.path.join(llvm_cov_path.parent, f"llvm-cxxfilt{llvm_cov_path.suffix}")
+  if os.path.exists(cxxfilt_path):
+    return cxxfilt_path
+
+  return shutil.which("llvm-cxxfilt")
+
+def __undname_lcov_info(logFilePath, outputPath):
+  # on Windows the names are mangled the msvc way and undname is used to unmangle them.
+  # undname processes the whole file at once
 
   #  0x0001  Remove leading underscores from Microsoft extended keywords
   #  0x0002  Disable expansion of Microsoft extended keywords
@@ -104,109 +242,392 @@ def __unmangle_function_names(logFilePath, profDataPath):
   #  0x8000  Disable enum / class / struct / union prefix
   #  0x20000 Disable expansion of __ptr64 keyword
 
-  # creating the unmangled .info file
   undname_path = required_tools.tool_paths_dict["undname_path"]
   flags : int = 0x0001 | 0x0002 | 0x0080 | 0x8000
-  unmangled_log_file_path = get_lcov_unmangled_filename(profDataPath)
-  cmd = f"\"{undname_path}\" {flags} {logFilePath} > {unmangled_log_file_path}"
-  os.system(cmd)
-
-  # now parse it and change the templated tokens
-  f = open(unmangled_log_file_path, "r+")
-  lines = f.readlines()
-  f.seek(0)
-
-  new_lines : list[str] = []
-  for line in lines:
-    if "FN:" not in line and "FNDA:" not in line: #function names start with FN, function execution counts with FNDA
-      new_lines.append(line)
-      continue
+  __run_llvm_tool([undname_path, str(flags), logFilePath], outputPath, writeHeader=False)
 
-    # if it's found, then the next element is the function name
-    first_comma = line.find(',')
-    func_name = line[first_comma+1:]
-    new_func_name = func_name.replace(',', '|')
-    if new_func_name != func_name:
-      line = line.replace(func_name, new_func_name)
-    new_lines.append(line)
+def __unmangle_function_names(logFilePath, profDataPath):
+  # the lcov info file will have mangled names, unfortunately using -Xdemangler doesn't work so we have to demangle them ourselves.
+  # templated functions will use ',' tokens to separate arguments, which makes for an invalid .info file
+  # as ',' separates the values of a line, so we change all ',' in function names to a different token to have a proper html report.
+  # the file is processed line by line, these files can be hundreds of MB
+  unmangled_log_file_path = get_lcov_unmangled_filename(profDataPath)
 
-  for line in new_lines:
-    f.write(line)
-  f.truncate()
-  f.close()
+  demangler = None
+  input_path = logFilePath
+  if regis.util.is_windows():
+    input_path = f"{unmangled_log_file_path}.undname"
+    __undname_lcov_info(logFilePath, input_path)
+  else:
+    cxxfilt_path = __find_cxxfilt()
+    if cxxfilt_path:
+      demangler = Demangler(cxxfiltPath=cxxfilt_path)
+    else:
+      diagnostics.log_warn(f"llvm-cxxfilt not found, function names in the coverage report will be mangled")
+
+  try:
+    with open(input_path, "r") as src, open(unmangled_log_file_path, "w") as dst:
+      for line in src:
+        # function names start with FN, function execution counts with FNDA
+        if line.startswith("FN:") or line.startswith("FNDA:"):
+          # the function name is everything after the first comma
+          first_comma = line.find(',')
+          func_name = line[first_comma+1:].rstrip('\n')
+          if demangler:
+            func_name = demangler.demangle(func_name)
+          line = f"{line[:first_comma]},{func_name.replace(',', '|')}\n"
+
+        dst.write(line)
+  finally:
+    if demangler:
+      demangler.close()
+
+  if input_path != logFilePath:
+    os.remove(input_path)
 
   return unmangled_log_file_path
 
+class LcovRecord():
+  """The coverage of a single source file in an lcov .info file"""
+  def __init__(self, sourceFile : str):
+    self.source_file = sourceFile
+    self.lines : dict[int, int] = {}            # line number -> execution count
+    self.functions : dict[str, list[int]] = {}  # function name -> [line number, execution count]
+    self.branches_found = 0
+    self.branches_hit = 0
+    self.digest = None
+    self._hasher = hashlib.sha1(sourceFile.encode('utf-8'))
+
+  def add(self, line : str):
+    self._hasher.update(line.encode('utf-8'))
+    key, _, value = line.partition(':')
+    if key == "DA":
+      values = value.split(',')
+      self.lines[int(values[0])] = self.lines.get(int(values[0]), 0) + int(values[1])
+    elif key == "FN":
+      line_nr, _, name = value.partition(',')
+      self.functions.setdefault(name, [int(line_nr), 0])[0] = int(line_nr)
+    elif key == "FNDA":
+      count, _, name = value.partition(',')
+      self.functions.setdefault(name, [0, 0])[1] += int(count)
+    elif key == "BRDA":
+      taken = value.split(',')[-1]
+      self.branches_found += 1
+      if taken not in ['-', '0']:
+        self.branches_hit += 1
+
+  def finish(self):
+    """Called when the whole record is read, the hash of the coverage data is finalized.
+    if the hash doesn't change, the page of the file doesn't either"""
+    self.digest = self._hasher.hexdigest()
+    self._hasher = None
+
+  def summary(self):
+    """Returns [lines found, lines hit, functions found, functions hit, branches found, branches hit]"""
+    lines_hit = len([count for count in self.lines.values() if count > 0])
+    functions_hit = len([function for function in self.functions.values() if function[1] > 0])
+    return [len(self.lines), lines_hit, len(self.functions), functions_hit, self.branches_found, self.branches_hit]
+
+def iter_lcov_records(infoPath : str):
+  """Yields the records of an lcov .info file one by one, so the whole file never has to be in memory"""
+  with open(infoPath, "r", errors="replace") as f:
+    record = None
+    for line in f:
+      line = line.rstrip('\n')
+      if line.startswith("SF:"):
+        record = LcovRecord(line[3:])
+      elif record is None:
+        continue
+      elif line == "end_of_record":
+        record.finish()
+        yield record
+        record = None
+      else:
+        record.add(line)
+
+_html_style = """<style>
+body { font-family: sans-serif; font-size: 13px; }
+table { border-collapse: collapse; }
+td, th { padding: 2px 8px; text-align: left; }
+pre { margin: 0; }
+.hi { background-color: #a7fc9d; }
+.med { background-color: #ffea20; }
+.lo { background-color: #ff6230; }
+.hit { background-color: #dcf4dc; }
+.miss { background-color: #fcd4d4; }
+.count { text-align: right; color: #606060; }
+</style>"""
+
+def __html_page_path(sourceFile : str):
+  """The page of a source file mirrors its location relative to the root"""
+  source_path = Path(os.path.abspath(sourceFile))
+  if root_path and source_path.is_relative_to(root_path):
+    relative_path = source_path.relative_to(root_path)
+  else:
+    relative_path = Path("external", *source_path.parts[1:])
+  return f"{relative_path.as_posix()}.html"
+
+def __coverage_class(hit : int, found : int):
+  rate = 100 if found == 0 else hit / found * 100
+  if rate >= 90:
+    return "hi", rate
+  if rate >= 75:
+    return "med", rate
+  return "lo", rate
+
+def __html_summary_cells(summary : list[int]):
+  cells = []
+  for found, hit in [(summary[0], summary[1]), (summary[2], summary[3]), (summary[4], summary[5])]:
+    css_class, rate = __coverage_class(hit, found)
+    cells.append(f'<td class="{css_class}">{rate:.1f}%</td><td class="count">{hit} / {found}</td>')
+  return "".join(cells)
+
+def __html_page(title : str, body : str):
+  return f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{html.escape(title)}</title>{_html_style}</head><body>{body}</body></html>'
+
+def _render_file_page(task):
+  """Render the page of a single source file, showing the execution count of every line.
+  The page isn't rendered again if the data it shows didn't change since the previous report.
+  Runs in a worker process, returns (page, digest, summary, whether it got rendered)"""
+  record, outputFolder, previousDigest = task
+  page = __html_page_path(record.source_file)
+  page_path = os.path.join(outputFolder, page)
+
+  # a page also shows the source, so that needs to be unchanged as well
+  digest = record.digest
+  if os.path.exists(record.source_file):
+    stat = os.stat(record.source_file)
+    digest = f"{digest}-{stat.st_mtime_ns}-{stat.st_size}"
+
+  if previousDigest == digest and os.path.exists(page_path):
+    return page, digest, record.summary(), False
+
+  rows = []
+  try:
+    with open(record.source_file, "r", errors="replace") as f:
+      source_lines = f.read().splitlines()
+  except OSError:
+    source_lines = []
+
+  num_lines = max([len(source_lines)] + list(record.lines.keys()))
+  for line_nr in range(1, num_lines + 1):
+    text = html.escape(source_lines[line_nr - 1]) if line_nr <= len(source_lines) else ""
+    count = record.lines.get(line_nr)
+    css_class = "" if count is None else ("hit" if count > 0 else "miss")
+    count_str = "" if count is None else str(count)
+    rows.append(f'<tr class="{css_class}"><td class="count">{line_nr}</td><td class="count">{count_str}</td><td><pre>{text}</pre></td></tr>')
+
+  functions = sorted(record.functions.items(), key=lambda function: function[1][0])
+  function_rows = [f'<tr class="{"hit" if count > 0 else "miss"}"><td>{html.escape(name)}</td><td class="count">{line_nr}</td><td class="count">{count}</td></tr>' for name, (line_nr, count) in functions]
+
+  body = f'<h2>{html.escape(record.source_file)}</h2>'
+  body += f'<table><tr><th>Lines</th><th></th><th>Functions</th><th></th><th>Branches</th><th></th></tr><tr>{__html_summary_cells(record.summary())}</tr></table>'
+  body += f'<h3>Functions</h3><table><tr><th>Name</th><th>Line</th><th>Count</th></tr>{"".join(function_rows)}</table>'
+  body += f'<h3>Source</h3><table>{"".join(rows)}</table>'
+
+  os.makedirs(Path(page_path).parent, exist_ok=True)
+  with open(page_path, "w", encoding="utf-8") as f:
+    f.write(__html_page(record.source_file, body))
+
+  return page, digest, record.summary(), True
+
+def __render_summary_page(pagePath : str, title : str, entries : list[tuple[str, str, list[int]]]):
+  """Render a table of (name, link, summary) entries"""
+  rows = [f'<tr><td><a href="{html.escape(link)}">{html.escape(name)}</a></td>{__html_summary_cells(summary)}</tr>' for name, link, summary in entries]
+  total = [sum(values) for values in zip(*[summary for _, _, summary in entries])] if entries else [0] * 6
+  body = f'<h2>{html.escape(title)}</h2>'
+  body += f'<table><tr><th>Name</th><th>Lines</th><th></th><th>Functions</th><th></th><th>Branches</th><th></th></tr>'
+  body += f'<tr><td><b>Total</b></td>{__html_summary_cells(total)}</tr>{"".join(rows)}</table>'
+
+  os.makedirs(Path(pagePath).parent, exist_ok=True)
+  with open(pagePath, "w", encoding="utf-8") as f:
+    f.write(__html_page(title, body))
+  return total
+
+# the page listing the files directly under the root, the index page of their directory is the root index
+_html_root_files_page = "_root_files.html"
+
+def __main_is_guarded():
+  """Spawned processes import the __main__ module of the parent again.
+  Its code only doesn't run again if it's behind an 'if __name__ == "__main__"' guard"""
+  main_path = getattr(sys.modules.get("__main__"), "__file__", None)
+  if main_path is None or not os.path.exists(main_path):
+    return True
+
+  with open(main_path, "r", errors="replace") as f:
+    return re.search(r'__name__\s*==\s*[\'"]__main__[\'"]', f.read()) is not None
+
+def render_html_report(infoPath : str, outputFolder : str, maxWorkers : int = None):
+  """Render an html report of an lcov .info file.
+  The .info file is streamed and the pages of the source files are rendered in a process pool.
+  Pages of source files whose coverage didn't change since the last report are reused.
+  This can be called from worker threads, so the pool spawns its processes instead of forking them.
+  Spawning requires the script that's run to guard its code with 'if __name__ == "__main__"',
+  if it doesn't, the pages are rendered in a thread pool instead"""
+  manifest_path = os.path.join(outputFolder, "pages.json")
+  previous_pages : dict[str, str] = {}
+  if os.path.exists(manifest_path):
+    previous_pages = regis.rex_json.load_file(manifest_path) or {}
+
+  pages : dict[str, str] = {}                                   # page path -> digest of the data it shows
+  directories : dict[str, list[tuple[str, str, list[int]]]] = {}  # directory -> [(file name, link, summary)]
+
+  # the tasks are generated on the task feeder thread of the pool, so that only reads
+  tasks = ((record, outputFolder, previous_pages.get(__html_page_path(record.source_file))) for record in iter_lcov_records(infoPath))
+
+  num_rendered = 0
+  num_workers = maxWorkers or os.cpu_count()
+  if __main_is_guarded():
+    pool = multiprocessing.get_context("spawn").Pool(num_workers)
+  else:
+    diagnostics.log_warn(f"{sys.modules['__main__'].__file__} has no 'if __name__ == \"__main__\"' guard, rendering the coverage html report on threads")
+    pool = ThreadPool(num_workers)
+
+  with pool:
+    for page, digest, summary, rendered in pool.imap_unordered(_render_file_page, tasks, chunksize=8):
+      pages[page] = digest
+      directories.setdefault(Path(page).parent.as_posix(), []).append((Path(page).stem, Path(page).name, summary))
+      if rendered:
+        num_rendered += 1
+
+  # remove the pages of files that are no longer part of the report
+  for page in previous_pages:
+    if page not in pages and os.path.exists(os.path.join(outputFolder, page)):
+      os.remove(os.path.join(outputFolder, page))
+
+  # the directory pages and the index are cheap, they're always rendered
+  index_entries = []
+  for directory in sorted(directories.keys()):
+    entries = sorted(directories[directory])
+    page = _html_root_files_page if directory == "." else f"{directory}/index.html"
+    total = __render_summary_page(os.path.join(outputFolder, page), directory, entries)
+    index_entries.append((directory, page, total))
+  __render_summary_page(os.path.join(outputFolder, "index.html"), f"Coverage report - {Path(infoPath).name}", index_entries)
+
+  regis.rex_json.save_file(manifest_path, pages)
+  diagnostics.log_info(f"coverage html report saved to {outputFolder} ({num_rendered} pages rendered, {len(pages) - num_rendered} reused)")
+  return 0
+
 def __generate_html_reports(unmangledLogFilePath):
-  lcov_path = required_tools.tool_paths_dict["lcov_path"]
-  perl_path = required_tools.tool_paths_dict['perl_path']
-  cmd = f"{perl_path} {lcov_path} {unmangledLogFilePath} -q -o {os.path.join(Path(unmangledLogFilePath).parent, html_report_folder)}"
-  os.system(cmd)
+  html_folder = os.path.join(Path(unmangledLogFilePath).parent, html_report_folder)
+  return render_html_report(unmangledLogFilePath, html_folder)
 
 def create_lcov_report(programPath, profDataPath):
-  if os.path.exists(html_report_folder):
-    shutil.rmtree(html_report_folder)
-  
   log_file_path = __create_mangled_lcov_info(programPath, profDataPath)
   unmangled_log_file_path = __unmangle_function_names(log_file_path, profDataPath)
-  __generate_html_reports(unmangled_log_file_path)
+  return __generate_html_reports(unmangled_log_file_path)
+
+# the reports that can be generated, each of them is an independent llvm-cov pass
+report_generators = {
+  "line": create_line_oriented_report,
+  "summary": create_file_level_summary,
+  "lcov": create_lcov_report,
+  "json_summary": create_coverage_summary,
+}
+
+def __get_report_outputs(kind : str, profDataPath):
+  """The files a report consists of, the report needs to be created again if any of them is missing"""
+  if kind == "line":
+    return [get_line_oriented_report_filename(profDataPath)]
+  if kind == "summary":
+    return [get_file_level_summary_filename(profDataPath)]
+  if kind == "json_summary":
+    return [get_coverage_summary_filename(profDataPath)]
+  if kind == "lcov":
+    unmangled_path = get_lcov_unmangled_filename(profDataPath)
+    return [unmangled_path, os.path.join(Path(unmangled_path).parent, html_report_folder, "index.html")]
+  return []
+
+def get_report_kinds():
+  """Returns the reports to generate, which can be limited in the settings.
+  eg. CI only needs the summary to gate on coverage and can skip the expensive html output"""
+  return settings.get("coverage_report_kinds", list(report_generators.keys()))
+
+def create_reports(coverageRuns : list[tuple[str, str]], reportKinds : list[str] = None, maxWorkers : int = None):
+  """Create the reports for a list of (program path, profdata path) pairs.
+  All reports of all programs are generated concurrently"""
+  if reportKinds is None:
+    reportKinds = get_report_kinds()
+
+  tasks = []
+  for kind in reportKinds:
+    if kind not in report_generators:
+      diagnostics.log_err(f"unknown coverage report kind: {kind}. Possible values: {list(report_generators.keys())}")
+      return 1
+
+  # reports that were already created from the same indexed file are skipped, as long as they still exist
+  artifact_caches = {prof_data_path: __load_artifact_cache(prof_data_path) for _, prof_data_path in coverageRuns}
+  for kind in reportKinds:
+    for program_path, prof_data_path in coverageRuns:
+      reports = artifact_caches[prof_data_path]["reports"]
+      if kind in reports:
+        if all(os.path.exists(output) for output in __get_report_outputs(kind, prof_data_path)):
+          diagnostics.log_info(f"{kind} coverage report of {prof_data_path} is up to date")
+          continue
+        reports.remove(kind)
+      tasks.append((kind, program_path, prof_data_path))
+
+  if len(tasks) == 0:
+    return 0
+
+  def _create_report(task):
+    kind, program_path, prof_data_path = task
+    rc = report_generators[kind](program_path, prof_data_path)
+    if rc != 0:
+      diagnostics.log_err(f"failed to create {kind} coverage report for {program_path}")
+    return rc
+
+  with ThreadPool(min(len(tasks), maxWorkers or os.cpu_count())) as pool:
+    return_codes = pool.map(_create_report, tasks)
+
+  rc = 0
+  for (kind, _, prof_data_path), report_rc in zip(tasks, return_codes):
+    rc |= report_rc
+    artifact_cache = artifact_caches[prof_data_path]
+    if report_rc == 0 and artifact_cache["key"] is not None:
+      artifact_cache["reports"].append(kind)
+
+  for prof_data_path, artifact_cache in artifact_caches.items():
+    if artifact_cache["key"] is not None:
+      regis.rex_json.save_file(__get_artifact_cache_filename(prof_data_path), artifact_cache)
+
+  return rc
 
 class CoverageCategory:
-  def __init__(self, total, missed, cover):
-    self._total : str = total   # total number of elements of the category
-    self._missed : str = missed # missed number of elements of the category
-    self._cover : str = cover  # percent of the category covered
+  def __init__(self, summary : dict):
+    self._total : int = int(summary.get('count', 0))     # total number of elements of the category
+    self._covered : int = int(summary.get('covered', 0)) # covered number of elements of the category
 
   def coverage(self):
-    if self._cover == '-': # no elements of category in file
+    if self._total == 0: # no elements of category in file
       return 100
     else:
-      return float(self._cover.strip('%'))
+      return self._covered / self._total * 100
 
   def total_str(self):
     return f"total: {self._total}"
 
   def missed_str(self):
-    return f"missed: {self._total}"
+    return f"missed: {self._total - self._covered}"
 
   def covered_str(self):
-    return f"covered: {self._total}"
+    return f"covered: {self._covered}"
 
 class FileSummary:
-  def __init__(self, line : str):
-    words = line.split()
-    self._filename = words[0]
-    self._regions_summary = CoverageCategory(words[1], words[2], words[3])    
-    self._functions_summary = CoverageCategory(words[4], words[5], words[6])    
-    self._lines_summary = CoverageCategory(words[7], words[8], words[9])    
-    self._branches_summary = CoverageCategory(words[10], words[11], words[12])    
+  def __init__(self, filename : str, summary : dict):
+    self._filename = filename
+    self._regions_summary = CoverageCategory(summary.get('regions', {}))
+    self._functions_summary = CoverageCategory(summary.get('functions', {}))
+    self._lines_summary = CoverageCategory(summary.get('lines', {}))
+    self._branches_summary = CoverageCategory(summary.get('branches', {}))
 
   def to_string(self):
-    result = ""
-    result += f"#################################"
-    result += f"coverage for file: {self._filename}"
-    result += f"REGIONS:"
-    result += f"---------------------------------"
-    result += self._regions_summary.total_str()
-    result += self._regions_summary.missed_str()
-    result += self._regions_summary.covered_str()
-    result += f"FUNCTIONS:"
-    result += f"---------------------------------"
-    result += self._functions_summary.total_str()
-    result += self._functions_summary.missed_str()
-    result += self._functions_summary.covered_str()
-    result += f"LINES:"
-    result += f"---------------------------------"
-    result += self._lines_summary.total_str()
-    result += self._lines_summary.missed_str()
-    result += self._lines_summary.covered_str()
-    result += f"BRANCHES:"
-    result += f"---------------------------------"
-    result += self._branches_summary.total_str()
-    result += self._branches_summary.missed_str()
-    result += self._branches_summary.covered_str()
-
-    return result
+    result = []
+    result.append(f"coverage for file: {self._filename}")
+    for name, category in [("REGIONS", self._regions_summary), ("FUNCTIONS", self._functions_summary), ("LINES", self._lines_summary), ("BRANCHES", self._branches_summary)]:
+      result.append(f"{name}: {category.total_str()}, {category.missed_str()}, {category.covered_str()}")
+
+    return "\n".join(result)
 
   def filename(self):
     return self._filename
@@ -219,61 +640,121 @@ class FileSummary:
     res += self._branches_summary.coverage()
     return res / 4
 
-def parse_file_summary(filepath):
-  file = open(filepath, "r")
+def iter_file_summaries(filepath):
+  """Yields the summary of every file in a 'llvm-cov export -summary-only' json file.
+  The file is streamed if ijson is available, as the export of a big program can be large"""
+  # format of the summary file:
+  # { "data": [ { "files": [ { "filename": ..., "summary": { "lines": { "count", "covered", "percent" }, ... } } ], "totals": {...} } ] }
+  with open(filepath, "rb") as file:
+    if ijson:
+      file_entries = ijson.items(file, 'data.item.files.item')
+    else:
+      file_entries = (file_entry for export in json.load(file)['data'] for file_entry in export['files'])
 
-  # format of file summary file:
-  # lines starting with '#' are comments
-  # lines with only consisting of '-' are separators 
-  
-  # Column names:
-  # Filename | Regions | Missed Regions | Cover | Functions | Missed Functions | Executed | Lines | Missed Lines | Cover | Branches | Missed Branches | Cover
-  # <separator>
-  # file 1
-  # file 2
-  # ...
-  # <separator>
-  # Total
-
-  file_summaries : list[FileSummary] = []
-  total_summary : FileSummary
-  lines = file.readlines()
-  column_names_processed = False
-  for line in lines:
-    if line.startswith('#'):
-      continue
+    for file_entry in file_entries:
+      yield FileSummary(file_entry['filename'], file_entry['summary'])
 
-    if re.search(r'[^-]', line).start() >= 200: # report files use a lot of '-' tokens as separators
-      column_names_processed = True
-      continue
+class CoverageGate:
+  """The coverage each file needs to reach, configured in the settings under 'coverage_gate':
+  'threshold' is the coverage needed by default, 'file_thresholds' maps globs to the coverage needed by matching files
+  and files matching any glob in 'ignore' are not checked"""
+  def __init__(self, gateSettings : dict = None):
+    if gateSettings is None:
+      gateSettings = settings.get("coverage_gate", {})
 
-    # the column names are displayed first, only after that do the actual files get shown
-    if column_names_processed == False:
-      continue
+    self._threshold : float = gateSettings.get("threshold", 100)
+    self._file_thresholds : dict[str, float] = gateSettings.get("file_thresholds", {})
+    self._ignore : list[str] = gateSettings.get("ignore", [])
 
-    line_words = line.split()
-    if len(line_words) == 0:
-      continue
+  def _matches(self, filename : str, pattern : str):
+    # globs can either be relative to the root or absolute
+    filename = Path(filename).as_posix()
+    relative_filename = filename
+    if os.path.isabs(filename):
+      relative_filename = Path(os.path.relpath(filename, root_path)).as_posix()
 
-    if "Files which contain no functions" in line:
-      continue
+    return fnmatch.fnmatch(relative_filename, pattern) or fnmatch.fnmatch(filename, pattern)
 
-    if line_words[0] == "TOTAL":  # filename == TOTAL
-      total_summary = FileSummary(line)
-    else:
-      file_summaries.append(FileSummary(line))
+  def is_ignored(self, filename : str):
+    return any(self._matches(filename, pattern) for pattern in self._ignore)
+
+  def threshold(self, filename : str):
+    for pattern, threshold in self._file_thresholds.items():
+      if self._matches(filename, pattern):
+        return threshold
+
+    return self._threshold
+
+def check_coverage(filepath, gate : CoverageGate = None):
+  """Check the coverage of every file in a coverage summary against the gate"""
+  if gate is None:
+    gate = CoverageGate()
+
+  if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+    diagnostics.log_err(f"coverage summary {filepath} is missing or empty, can't check coverage")
+    return 1
 
+  # a truncated summary fails the gate instead of crashing the job
+  parse_errors = (ValueError, KeyError, ijson.JSONError) if ijson else (ValueError, KeyError)
   result = 0
+  try:
+    for file_summary in iter_file_summaries(filepath):
+      if gate.is_ignored(file_summary.filename()):
+        continue
+
+      threshold = gate.threshold(file_summary.filename())
+      if file_summary.coverage() < threshold:
+        result = 1
+        diagnostics.log_err(f"File {file_summary.filename()} has {file_summary.coverage():.2f}% coverage, {threshold}% required")
+  except parse_errors as ex:
+    diagnostics.log_err(f"failed to parse coverage summary {filepath}: {ex}")
+    return 1
+
+  if result != 0:
+    diagnostics.log_err(f"Not enough coverage. More info found: {filepath}")
+    diagnostics.log_err(f"Alternatively, investigate the line coverage file or html report located at {Path(filepath).parent}")    
+
+  return result
 
-  for file_summary in file_summaries:
-    if file_summary.coverage() != 100:
+def check_diff_coverage(programPath, profDataPath, changedLines : dict[str, list[tuple[int, int]]], gate : CoverageGate = None):
+  """Check the coverage of the changed lines only, changedLines maps absolute file paths to (first line, last line) ranges.
+  Only the changed files are exported, lines that aren't instrumented are not taken into account"""
+  if gate is None:
+    gate = CoverageGate()
+
+  changed_files = [file for file in changedLines if os.path.exists(file) and not gate.is_ignored(file)]
+  if len(changed_files) == 0:
+    diagnostics.log_info("no changed files to check coverage of")
+    return 0
+
+  llvm_cov_path = required_tools.tool_paths_dict["llvm_cov_path"]
+  log_file_path = get_diff_lcov_filename(profDataPath)
+  cmd = [llvm_cov_path, "export", "-format=lcov", *__program_args(programPath), f"-instr-profile={profDataPath}"]
+  cmd.extend(changed_files)
+  if __run_llvm_tool(cmd, log_file_path, writeHeader=False) != 0:
+    diagnostics.log_err(f"failed to export coverage of changed files for {programPath}")
+    return 1
+
+  changed_ranges = {os.path.normcase(os.path.normpath(file)): changedLines[file] for file in changed_files}
+  result = 0
+  for record in iter_lcov_records(log_file_path):
+    ranges = changed_ranges.get(os.path.normcase(os.path.normpath(record.source_file)))
+    if ranges is None:
+      continue
+
+    changed = [line for line in record.lines if any(first <= line <= last for first, last in ranges)]
+    if len(changed) == 0:
+      continue
+
+    missed = sorted([line for line in changed if record.lines[line] == 0])
+    coverage = (len(changed) - len(missed)) / len(changed) * 100
+    threshold = gate.threshold(record.source_file)
+    if coverage < threshold:
       result = 1
-      # diagnostics.log_err(f"File {file_summary.filename()} was not fully covered, please see below for more details")
-      # diagnostics.log_err(f"Alternatively, investigate the line coverage report file for this file")    
-      # diagnostics.log_err(f"This file is located at {Path(filepath).parent}")    
+      diagnostics.log_err(f"File {record.source_file} has {coverage:.2f}% coverage of changed lines, {threshold}% required")
+      diagnostics.log_err(f"uncovered changed lines: {', '.join([str(line) for line in missed])}")
 
   if result != 0:
-    diagnostics.log_err(f"No full coverage. More info found: {filepath}")
-    diagnostics.log_err(f"Alternatively, investigate the line coverage file or html report located at {Path(filepath).parent}")    
+    diagnostics.log_err(f"Not enough coverage of changed lines. More info found: {log_file_path}")
 
   return result
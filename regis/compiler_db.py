@@ -1,19 +1,157 @@
 import os
+import re
 import json
+import shlex
+import regis.util
+
+def _split_windows_command(command : str):
+  """Split a command line the way Windows programs do.
+  A non posix shlex split keeps the quotes (eg. "C:/src/file.cpp") and splits -I"C:/some dir" in two,
+  so the arguments wouldn't match what the compiler sees"""
+  args : list[str] = []
+  arg = ""
+  has_arg = False
+  in_quotes = False
+  idx = 0
+  while idx < len(command):
+    char = command[idx]
+    if char == '\\':
+      # backslashes are only special in front of a quote
+      num_backslashes = 0
+      while idx < len(command) and command[idx] == '\\':
+        num_backslashes += 1
+        idx += 1
+      if idx < len(command) and command[idx] == '"':
+        arg += '\\' * (num_backslashes // 2)
+        if num_backslashes % 2 == 1:
+          arg += '"'
+          idx += 1
+      else:
+        arg += '\\' * num_backslashes
+      has_arg = True
+      continue
+
+    if char == '"':
+      in_quotes = not in_quotes
+      has_arg = True
+    elif char in ' \t' and not in_quotes:
+      if has_arg:
+        args.append(arg)
+      arg = ""
+      has_arg = False
+    else:
+      arg += char
+      has_arg = True
+    idx += 1
+
+  if has_arg:
+    args.append(arg)
+  return args
 
 class CompileDBEntry:
   def __init__(self, jsonEntry):
     self.directory = jsonEntry['directory']
-    self.command = jsonEntry['command']
-    self.file = jsonEntry['file']
-    self.output = jsonEntry['output']
+    self.command = jsonEntry.get('command')
+    self.args = jsonEntry.get('arguments')
+    self.source = jsonEntry['file']
+    self.file = os.path.normpath(os.path.join(self.directory, jsonEntry['file']))
+    self.output = jsonEntry.get('output')
+
+  def arguments(self):
+    """Returns the compiler command as a list of arguments"""
+    if self.args is not None:
+      return self.args
+
+    if not regis.util.is_windows():
+      return shlex.split(self.command)
+
+    return _split_windows_command(self.command)
+
+  def flags(self):
+    """Returns the compiler command without the source file and the output files.
+    These are the same for all files that get compiled the same way"""
+    flags : list[str] = []
+    output_flags = ['-o', '-MF', '-MT', '-MQ']
+    output_prefixes = ['/Fo', '/Fd', '-o']
+    args = self.arguments()
+    idx = 0
+    while idx < len(args):
+      arg = args[idx]
+      if arg in output_flags:
+        idx += 2
+        continue
+
+      if arg not in [self.source, self.file] and not any(arg.startswith(prefix) for prefix in output_prefixes):
+        flags.append(arg)
+
+      idx += 1
+
+    return flags
+
+  def include_dirs(self):
+    """Returns the absolute include directories passed to the compiler"""
+    include_dirs : list[str] = []
+    args = self.arguments()
+    flags = ['-I', '/I', '-isystem', '-iquote', '-idirafter', '/external:I']
+    idx = 0
+    while idx < len(args):
+      arg = args[idx]
+      for flag in flags:
+        if arg == flag and idx + 1 < len(args):
+          idx += 1
+          include_dirs.append(args[idx])
+          break
+        if arg.startswith(flag) and len(arg) > len(flag):
+          include_dirs.append(arg[len(flag):])
+          break
+      idx += 1
+
+    return [os.path.normpath(os.path.join(self.directory, dir)) for dir in include_dirs]
 
 class CompileDB:
   def __init__(self, path):
-    database = json.load(open('compile_commands.json'))
+    """Loads a compiler database, path is either the compile_commands.json file or the folder holding it"""
+    if os.path.isdir(path):
+      path = os.path.join(path, 'compile_commands.json')
+
+    with open(path) as f:
+      database = json.load(f)
     self.entries = list([CompileDBEntry(entry)
            for entry in database])
 
-db = CompileDB('compile_commands.json')
-for entry in db.entries:
-  print(entry.file)
\ No newline at end of file
+class IncludeScanner:
+  """Finds the headers a file includes, directly or indirectly, by scanning its #include directives.
+  This doesn't run the preprocessor, so includes behind conditionals are always followed."""
+  _include_regex = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', re.MULTILINE)
+
+  def __init__(self):
+    self._direct_includes : dict[str, list[str]] = {}
+
+  def direct_includes(self, path : str):
+    """Returns the include names as written in the file"""
+    if path not in self._direct_includes:
+      try:
+        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+          self._direct_includes[path] = IncludeScanner._include_regex.findall(f.read())
+      except OSError:
+        self._direct_includes[path] = []
+
+    return self._direct_includes[path]
+
+  def find_includes(self, file : str, includeDirs : list[str]):
+    """Returns the normalized absolute paths of all headers included by the file that could be found"""
+    found : set[str] = set()
+    to_scan = [os.path.normpath(file)]
+    while to_scan:
+      current = to_scan.pop()
+      search_dirs = [os.path.dirname(current)] + includeDirs
+      for name in self.direct_includes(current):
+        for dir in search_dirs:
+          header = os.path.normpath(os.path.join(dir, name))
+          if os.path.isfile(header):
+            if header not in found:
+              found.add(header)
+              to_scan.append(header)
+            break
+
+    return found
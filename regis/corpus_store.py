@@ -0,0 +1,209 @@
+# ============================================
+#
+# Author: Nick De Breuck
+# Twitter: @nick_debreuck
+#
+# File: corpus_store.py
+# Copyright (c) Nick De Breuck 2023
+#
+# ============================================
+
+# Fuzz corpora are saved in a single store, shared by all fuzzers and kept across runs.
+# Every input is saved once, under the hash of its content.
+# A fuzzer gets a view on the store: a directory with hardlinks to the inputs it uses,
+# so no inputs have to be copied to start a fuzzer.
+# The inputs a fuzzer finds are added to the store after it ran.
+
+import os
+import time
+import shutil
+import hashlib
+import subprocess
+import regis.rex_json
+import regis.diagnostics
+
+class CorpusStore():
+  """A content addressed store of fuzzer inputs"""
+  def __init__(self, storeDir : str, maxBytes : int = 1 << 30):
+    self.store_dir = storeDir
+    self.max_bytes = maxBytes
+    self.objects_dir = os.path.join(storeDir, "objects")
+    self.views_dir = os.path.join(storeDir, "views")
+    self.index_path = os.path.join(storeDir, "index.json")
+
+    # objects: hash -> { size, last_used, fuzzers }
+    # fuzzers: fuzzer -> { last_distilled }
+    # imported: directory -> signature of its content when it got imported
+    self.index = { "objects": {}, "fuzzers": {}, "imported": {} }
+    if os.path.exists(self.index_path):
+      self.index = regis.rex_json.load_file(self.index_path) or self.index
+    self.index.setdefault("imported", {})
+
+  def _object_path(self, digest : str):
+    return os.path.join(self.objects_dir, digest[:2], digest)
+
+  def _link(self, src : str, dst : str):
+    # hardlinks aren't supported by every file system, fall back to copying
+    try:
+      os.link(src, dst)
+    except OSError:
+      shutil.copyfile(src, dst)
+
+  def _hash(self, path : str):
+    # libFuzzer names the inputs it saves after their sha1 as well
+    hasher = hashlib.sha1()
+    with open(path, "rb") as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+  def add(self, fuzzer : str, path : str):
+    """Add an input to the store for a fuzzer, returns its hash"""
+    digest = self._hash(path)
+    objects = self.index["objects"]
+    if digest not in objects:
+      object_path = self._object_path(digest)
+      os.makedirs(os.path.dirname(object_path), exist_ok=True)
+      if not os.path.exists(object_path):
+        self._link(path, object_path)
+      objects[digest] = { "size": os.path.getsize(object_path), "last_used": time.time(), "fuzzers": [] }
+
+    if fuzzer not in objects[digest]["fuzzers"]:
+      objects[digest]["fuzzers"].append(fuzzer)
+    self.index["fuzzers"].setdefault(fuzzer, { "last_distilled": time.time() })
+    return digest
+
+  def import_dir(self, fuzzer : str, directory : str):
+    """Add all inputs of an existing corpus directory to the store.
+    The directory is left as is, eg. it can be a seed corpus in source control.
+    It's only imported again when its files changed since the last import"""
+    if not os.path.isdir(directory):
+      return 0
+
+    entries = sorted([entry for entry in os.scandir(directory) if entry.is_file()], key=lambda entry: entry.name)
+    hasher = hashlib.sha1()
+    for entry in entries:
+      stat = entry.stat()
+      hasher.update(f"{entry.name}-{stat.st_size}-{stat.st_mtime_ns}".encode('utf-8'))
+
+    key = f"{fuzzer} - {os.path.abspath(directory)}"
+    signature = hasher.hexdigest()
+    if self.index["imported"].get(key) == signature:
+      return 0
+
+    for entry in entries:
+      self.add(fuzzer, entry.path)
+
+    self.index["imported"][key] = signature
+    return len(entries)
+
+  def members(self, fuzzer : str):
+    return [digest for digest, info in self.index["objects"].items() if fuzzer in info["fuzzers"]]
+
+  def prepare_view(self, fuzzer : str, viewName : str = None):
+    """Create the corpus directory of a fuzzer, holding hardlinks to all its inputs in the store.
+    A fuzzer that's new to the store starts from the inputs of all other fuzzers.
+    Fuzzers running at the same time each need a view with a different name"""
+    view_dir = os.path.join(self.views_dir, viewName or fuzzer)
+    if os.path.exists(view_dir):
+      shutil.rmtree(view_dir)
+    os.makedirs(view_dir)
+
+    digests = self.members(fuzzer) or list(self.index["objects"].keys())
+    now = time.time()
+    for digest in digests:
+      self._link(self._object_path(digest), os.path.join(view_dir, digest))
+      self.index["objects"][digest]["last_used"] = now
+
+    return view_dir
+
+  def ingest_view(self, fuzzer : str, viewName : str = None):
+    """Add the inputs the fuzzer saved in its view to the store, returns the amount of new inputs"""
+    view_dir = os.path.join(self.views_dir, viewName or fuzzer)
+    if not os.path.isdir(view_dir):
+      return 0
+
+    num_new = 0
+    for entry in os.scandir(view_dir):
+      if not entry.is_file():
+        continue
+
+      # inputs linked from the store are named after their hash already
+      info = self.index["objects"].get(entry.name)
+      if info is not None and fuzzer in info["fuzzers"]:
+        continue
+
+      self.add(fuzzer, entry.path)
+      num_new += 1
+
+    return num_new
+
+  def needs_distill(self, fuzzer : str, interval : float):
+    last_distilled = self.index["fuzzers"].get(fuzzer, {}).get("last_distilled", 0)
+    return time.time() - last_distilled >= interval
+
+  def distill(self, fuzzer : str, program : str, timeout : float = None):
+    """Reduce the inputs of a fuzzer to the smallest set with the same coverage, using -merge=1.
+    Inputs that are no longer used by any fuzzer are removed from the store"""
+    view_dir = self.prepare_view(fuzzer)
+    distilled_dir = os.path.join(self.views_dir, f"{fuzzer}_distilled")
+    if os.path.exists(distilled_dir):
+      shutil.rmtree(distilled_dir)
+    os.makedirs(distilled_dir)
+
+    try:
+      proc = subprocess.run([program, "-merge=1", distilled_dir, view_dir], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+      rc = proc.returncode
+    except subprocess.TimeoutExpired:
+      rc = 1
+
+    if rc != 0:
+      regis.diagnostics.log_warn(f"failed to distill the corpus of {fuzzer}, keeping all inputs")
+      shutil.rmtree(distilled_dir)
+      return rc
+
+    kept = set([self._hash(entry.path) for entry in os.scandir(distilled_dir) if entry.is_file()])
+    num_before = len(self.members(fuzzer))
+    for digest in self.members(fuzzer):
+      if digest not in kept:
+        self.index["objects"][digest]["fuzzers"].remove(fuzzer)
+    shutil.rmtree(distilled_dir)
+
+    self.index["fuzzers"].setdefault(fuzzer, {})["last_distilled"] = time.time()
+    self._remove_unused()
+    regis.diagnostics.log_info(f"distilled the corpus of {fuzzer} from {num_before} to {len(kept)} inputs")
+    return 0
+
+  def _remove_object(self, digest : str):
+    object_path = self._object_path(digest)
+    if os.path.exists(object_path):
+      os.remove(object_path)
+    del self.index["objects"][digest]
+
+  def _remove_unused(self):
+    for digest in [digest for digest, info in self.index["objects"].items() if len(info["fuzzers"]) == 0]:
+      self._remove_object(digest)
+
+  def size(self):
+    return sum([info["size"] for info in self.index["objects"].values()])
+
+  def evict(self):
+    """Remove the least recently used inputs until the store fits in its maximum size"""
+    total_size = self.size()
+    if total_size <= self.max_bytes:
+      return 0
+
+    num_evicted = 0
+    for digest, info in sorted(self.index["objects"].items(), key=lambda item: item[1]["last_used"]):
+      if total_size <= self.max_bytes:
+        break
+      total_size -= info["size"]
+      self._remove_object(digest)
+      num_evicted += 1
+
+    regis.diagnostics.log_info(f"evicted {num_evicted} inputs from the corpus store to stay under {self.max_bytes} bytes")
+    return num_evicted
+
+  def save(self):
+    os.makedirs(self.store_dir, exist_ok=True)
+    regis.rex_json.save_file(self.index_path, self.index)
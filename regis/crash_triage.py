@@ -0,0 +1,148 @@
+# ============================================
+#
+# Author: Nick De Breuck
+# Twitter: @nick_debreuck
+#
+# File: crash_triage.py
+# Copyright (c) Nick De Breuck 2023
+#
+# ============================================
+
+# A fuzzer can save the same crash many times under different inputs.
+# Triage reproduces every crash artifact, groups them by the stack they crash with
+# and minimizes the input of one crash per group, so only unique crashes with small reproducers are reported.
+
+import os
+import time
+import subprocess
+import regis.rex_json
+import regis.diagnostics
+import regis.sanitizer_reports
+
+from pathlib import Path
+from multiprocessing.pool import ThreadPool
+
+# the prefixes libFuzzer uses to save the inputs that made it fail
+artifact_prefixes = ['crash-', 'leak-', 'oom-', 'timeout-']
+
+# the time a single reproduction of a crash is allowed to take
+reproduce_timeout = 60
+
+class CrashGroup():
+  """Crash artifacts that crash with the same stack"""
+  def __init__(self, signature : str, finding : regis.sanitizer_reports.SanitizerFinding):
+    self.signature = signature
+    self.finding = finding
+    self.artifacts : list[str] = []
+    self.reproducer = None
+
+  def to_dict(self):
+    return {
+      "signature": self.signature,
+      "sanitizer": self.finding.sanitizer if self.finding else None,
+      "kind": self.finding.kind if self.finding else "unknown",
+      "frames": [frame.to_string() for frame in self.finding.frames if not frame.is_runtime()][:regis.sanitizer_reports.signature_depth] if self.finding else [],
+      "count": len(self.artifacts),
+      "reproducer": self.reproducer,
+      "artifacts": self.artifacts
+    }
+
+def _crash_env():
+  """Crashes are reproduced unsymbolized, symbolizing happens afterwards for all crashes at once"""
+  env = os.environ.copy()
+  env["ASAN_OPTIONS"] = "print_stacktrace=1:symbolize=0"
+  env["UBSAN_OPTIONS"] = "print_stacktrace=1:symbolize=0"
+  return env
+
+def find_artifacts(artifactDir : str):
+  """Returns the crash artifacts libFuzzer saved in the directory"""
+  if not os.path.exists(artifactDir):
+    return []
+
+  return sorted([os.path.join(artifactDir, file) for file in os.listdir(artifactDir) if any(file.startswith(prefix) for prefix in artifact_prefixes)])
+
+def reproduce(program : str, artifact : str):
+  """Run the fuzzer on a single artifact and return the finding it crashes with, if any"""
+  try:
+    proc = subprocess.run([program, artifact], env=_crash_env(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=reproduce_timeout)
+    output = proc.stderr.decode('utf-8', errors='replace')
+  except subprocess.TimeoutExpired:
+    return None
+
+  findings = regis.sanitizer_reports.parse_report(output)
+  return findings[0] if len(findings) > 0 else None
+
+def group_crashes(program : str, artifacts : list[str], symbolizer, maxWorkers : int = None):
+  """Reproduce all artifacts in parallel and group them by their stack"""
+  if len(artifacts) == 0:
+    return []
+
+  with ThreadPool(min(len(artifacts), maxWorkers or os.cpu_count())) as pool:
+    findings = pool.map(lambda artifact: reproduce(program, artifact), artifacts)
+
+  groups : dict[str, CrashGroup] = {}
+  for artifact, finding in zip(artifacts, findings):
+    # artifacts that don't reproduce are grouped by the type of artifact
+    if finding is None:
+      signature = f"not-reproduced-{Path(artifact).name.split('-')[0]}"
+    else:
+      if symbolizer:
+        symbolizer.symbolize_findings([finding])
+      signature = finding.signature()
+
+    if signature not in groups:
+      groups[signature] = CrashGroup(signature, finding)
+    groups[signature].artifacts.append(artifact)
+
+  return list(groups.values())
+
+def minimize(program : str, group : CrashGroup, outputDir : str, seconds : int):
+  """Minimize the first artifact of the group, the result is saved in the output directory"""
+  artifact = group.artifacts[0]
+  minimized_path = os.path.join(outputDir, f"minimized-{group.signature[:16]}")
+  cmd = [program, "-minimize_crash=1", f"-max_total_time={seconds}", f"-exact_artifact_path={minimized_path}", artifact]
+  try:
+    # the fuzzer should stop by itself after the time budget, the extra time is for it to wrap up
+    subprocess.run(cmd, env=_crash_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=seconds + 30)
+  except subprocess.TimeoutExpired:
+    pass
+
+  group.reproducer = minimized_path if os.path.exists(minimized_path) else artifact
+  return group
+
+def triage(program : str, artifactDir : str, outputDir : str, timeBudget : int, symbolizer = None, maxWorkers : int = None):
+  """Group the crash artifacts of a fuzzer by stack and minimize one of every group.
+  The minimization of all groups runs in parallel and finishes within the time budget (in seconds)"""
+  start = time.time()
+  groups = group_crashes(program, find_artifacts(artifactDir), symbolizer, maxWorkers)
+  if len(groups) == 0:
+    return groups
+
+  os.makedirs(outputDir, exist_ok=True)
+
+  # the remaining budget is divided over the groups, taking into account that they run in parallel
+  # only crashes that reproduce are worth minimizing
+  reproducible_groups = [group for group in groups if group.finding is not None]
+  for group in groups:
+    group.reproducer = group.artifacts[0]
+
+  remaining = timeBudget - (time.time() - start)
+  num_workers = min(len(reproducible_groups), maxWorkers or os.cpu_count())
+  if num_workers > 0 and remaining >= 1:
+    num_waves = -(-len(reproducible_groups) // num_workers)
+    seconds = max(1, int(remaining / num_waves))
+    with ThreadPool(num_workers) as pool:
+      pool.map(lambda group: minimize(program, group, outputDir, seconds), reproducible_groups)
+
+  return groups
+
+def save_report(groups : list[CrashGroup], reportPath : str):
+  """Save a compact report of the unique crashes and print a line for each of them"""
+  for group in groups:
+    kind = group.finding.kind if group.finding else "not reproduced"
+    top_frame = next((frame for frame in group.finding.frames if not frame.is_runtime()), None) if group.finding else None
+    location = f" in {top_frame.function or top_frame.key()} {top_frame.location or ''}" if top_frame else ""
+    regis.diagnostics.log_err(f"{kind}{location} ({len(group.artifacts)} artifact(s)), reproducer: {group.reproducer}")
+
+  regis.rex_json.save_file(reportPath, [group.to_dict() for group in groups])
+  regis.diagnostics.log_err(f"crash report saved to {reportPath}")
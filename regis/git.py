@@ -1,4 +1,5 @@
 import os
+import re
 
 import regis.util
 import regis.rex_json
@@ -15,15 +16,67 @@ def __zsplit(s: str) -> list[str]:
       return []
   
 def get_staged_files():
-  cmd = 'git diff --staged --name-only --no-ext-diff'
+  cmd = ['git', 'diff', '--staged', '--name-only', '--no-ext-diff']
   output, errc = regis.util.run_and_get_output(cmd)
   return __zsplit(output)
 
 def get_unstaged_files():
-  cmd = 'git diff --name-only --no-ext-diff'
+  cmd = ['git', 'diff', '--name-only', '--no-ext-diff']
   output, errc = regis.util.run_and_get_output(cmd)
   return __zsplit(output)
 
+def get_toplevel():
+  cmd = ['git', 'rev-parse', '--show-toplevel']
+  output, errc = regis.util.run_and_get_output(cmd)
+  return os.path.normpath(output.strip('\n'))
+
+def parse_diff_hunks(diff : str):
+  """Parses the output of git diff -U0 into the lines that were added or changed in each file.
+  Returns a dict mapping the file path, relative to the repository root, to a list of (first line, last line) ranges"""
+  hunks : dict[str, list[tuple[int, int]]] = {}
+  current_file = None
+  for line in diff.splitlines():
+    if line.startswith('+++ '):
+      path = line[4:].rstrip('\t')
+      # deleted files don't have any lines left to look at
+      current_file = None if path == '/dev/null' else path.removeprefix('b/')
+      continue
+
+    if current_file is None:
+      continue
+
+    # hunk header format: @@ -<start>[,<count>] +<start>[,<count>] @@
+    match = re.match(r'@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@', line)
+    if not match:
+      continue
+
+    start = int(match.group(1))
+    count = int(match.group(2)) if match.group(2) is not None else 1
+    if count == 0:
+      # only lines got removed, nothing to look at in the new version of the file
+      continue
+
+    hunks.setdefault(current_file, []).append((start, start + count - 1))
+
+  return hunks
+
+def get_changed_lines(base : str = None, staged : bool = False, files : list[str] = []):
+  """Returns the lines that were added or changed, compared to base (or the index if base is not specified).
+  Returns a dict mapping the absolute file path to a list of (first line, last line) ranges"""
+  cmd = ['git', 'diff', '-U0', '--no-color', '--no-ext-diff']
+  if staged:
+    cmd.append('--staged')
+  if base:
+    cmd.append(base)
+  if files:
+    cmd.append('--')
+    cmd.extend(files)
+
+  output, errc = regis.util.run_and_get_output(cmd)
+  toplevel = get_toplevel()
+  hunks = parse_diff_hunks(output)
+  return {os.path.normpath(os.path.join(toplevel, file)): lines for file, lines in hunks.items()}
+
 def get_local_branchname():
   cmd = 'git rev-parse --abbrev-ref HEAD'
   output, errc = regis.util.run_and_get_output(cmd)
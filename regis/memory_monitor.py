@@ -0,0 +1,142 @@
+# ============================================
+#
+# Author: Nick De Breuck
+# Twitter: @nick_debreuck
+#
+# File: memory_monitor.py
+# Copyright (c) Nick De Breuck 2023
+#
+# ============================================
+
+# Heavy tools like clang-tidy and include-what-you-use can take several GB per process.
+# Running a fixed amount of them in parallel can run the machine out of memory.
+# The memory monitor keeps track of the memory used by every process it launched
+# and only hands out new tasks when there's enough memory left to run them.
+
+import threading
+import time
+import psutil
+
+class MemorySlot():
+  """The memory reserved for a single process launched through the memory monitor"""
+  def __init__(self, expectedBytes : int):
+    self.expected_bytes = expectedBytes
+    self.pid = None
+    self.rss = 0
+    self.peak_rss = 0
+    self.sampled = False
+
+  def attach(self, pid : int):
+    """Start tracking the memory of the process with the given pid"""
+    self.pid = pid
+
+  def outstanding_bytes(self):
+    """The memory we expect the process still needs on top of what it uses now"""
+    return max(0, self.expected_bytes - self.rss)
+
+class MemoryMonitor():
+  """Hands out tasks when there's enough memory available to run them"""
+  def __init__(self, reservedBytes : int = None, pollInterval : float = 0.25):
+    # by default, we always keep 10% of the physical memory free for the rest of the system
+    if reservedBytes is None:
+      reservedBytes = psutil.virtual_memory().total // 10
+
+    self.reserved_bytes = reservedBytes
+    self.poll_interval = pollInterval
+    self._condition = threading.Condition()
+    self._slots : list[MemorySlot] = []
+    self._sampler = None
+
+  def headroom(self):
+    """Returns the memory that's free to use for new processes"""
+    available = psutil.virtual_memory().available
+    outstanding = sum(slot.outstanding_bytes() for slot in self._slots)
+    return available - outstanding - self.reserved_bytes
+
+  def take(self, tasks : list, expectedBytes):
+    """Removes the first task from the list that fits in the available memory and returns it together with its memory slot.
+    expectedBytes is a callable returning the memory a task is expected to use.
+    Blocks until a task fits. If nothing is running, the first task is always returned so we can't starve.
+    Returns (None, None) when there are no tasks left and none are running anymore,
+    as a running task can still put new tasks in the list."""
+    with self._condition:
+      while True:
+        if len(tasks) == 0:
+          if len(self._slots) == 0:
+            return None, None
+          self._condition.wait(self.poll_interval)
+          continue
+
+        headroom = self.headroom()
+        for idx, task in enumerate(tasks):
+          expected_bytes = expectedBytes(task)
+          if expected_bytes <= headroom or len(self._slots) == 0:
+            return tasks.pop(idx), self._reserve(expected_bytes)
+
+        self._condition.wait(self.poll_interval)
+
+  def put(self, tasks : list, newTasks : list):
+    """Adds tasks to the front of the list, so they're handed out next.
+    This should be called before the memory slot of the task adding them is released"""
+    with self._condition:
+      tasks[0:0] = newTasks
+      self._condition.notify_all()
+
+  def release(self, slot : MemorySlot):
+    """Releases the memory of a finished process and returns the peak memory it used.
+    Returns None if the process exited before its memory could be sampled"""
+    with self._condition:
+      if slot in self._slots:
+        self._sample(slot)
+        self._slots.remove(slot)
+        self._condition.notify_all()
+
+    return slot.peak_rss if slot.sampled else None
+
+  def _reserve(self, expectedBytes : int):
+    slot = MemorySlot(expectedBytes)
+    self._slots.append(slot)
+
+    if self._sampler is None or not self._sampler.is_alive():
+      self._sampler = threading.Thread(target=self._sample_loop)
+      self._sampler.daemon = True
+      self._sampler.start()
+
+    return slot
+
+  def _sample_loop(self):
+    while True:
+      with self._condition:
+        if len(self._slots) == 0:
+          self._sampler = None
+          return
+
+        for slot in self._slots:
+          self._sample(slot)
+
+        # memory could've been freed up, so let waiting workers check again
+        self._condition.notify_all()
+
+      time.sleep(self.poll_interval)
+
+  def _sample(self, slot : MemorySlot):
+    if slot.pid is None:
+      return
+
+    try:
+      # tools like iwyu_tool.py spawn the actual tool as a child process
+      # so the memory of the whole process tree is tracked
+      proc = psutil.Process(slot.pid)
+      rss = proc.memory_info().rss
+      for child in proc.children(recursive=True):
+        try:
+          rss += child.memory_info().rss
+        except psutil.Error:
+          pass
+    except psutil.Error:
+      # the process has already exited
+      return
+
+    slot.rss = rss
+    slot.peak_rss = max(slot.peak_rss, rss)
+    slot.sampled = True
@@ -14,16 +14,20 @@ import argparse
 import codecs
 import difflib
 import fnmatch
+import hashlib
 import io
 import errno
+import json
 import multiprocessing
 import os
+import re
 import signal
 import subprocess
 import sys
 import traceback
 
 from functools import partial
+from multiprocessing.pool import ThreadPool
 
 try:
     from subprocess import DEVNULL  # py3k
@@ -58,38 +62,202 @@ def excludes_from_file(ignore_file):
             raise
     return excludes;
 
+def compile_excludes(exclude):
+    """Compiles the glob-like exclude patterns into a single regex.
+    Returns None if there's nothing to exclude."""
+    if not exclude:
+        return None
+    return re.compile('|'.join(
+        '(?:{})'.format(fnmatch.translate(os.path.normcase(pattern)))
+        for pattern in exclude))
+
+
+def is_excluded(exclude_regex, path):
+    # same case handling as fnmatch.fnmatch
+    return exclude_regex is not None and exclude_regex.match(os.path.normcase(path)) is not None
+
+
+def walk_files(directory, extensions, exclude_regex):
+    """Lists the files with the given extensions under the directory.
+    Excluded directories are never entered."""
+    out = []
+    to_walk = [directory]
+    while to_walk:
+        dirpath = to_walk.pop()
+        try:
+            with os.scandir(dirpath) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            path = os.path.join(dirpath, entry.name)
+            if entry.is_dir():
+                # like os.walk(), symlinked directories aren't followed
+                if not entry.is_symlink() and not is_excluded(exclude_regex, path):
+                    to_walk.append(path)
+            elif os.path.splitext(entry.name)[1][1:] in extensions and not is_excluded(exclude_regex, path):
+                out.append(path)
+    return out
+
+
 def list_files(files, recursive=False, extensions=None, exclude=None):
     if extensions is None:
         extensions = []
     if exclude is None:
         exclude = []
 
+    extensions = set(extensions)
+    exclude_regex = compile_excludes(exclude)
+
     out = []
     for file in files:
         if recursive and os.path.isdir(file):
-            for dirpath, dnames, fnames in os.walk(file):
-                fpaths = [os.path.join(dirpath, fname) for fname in fnames]
-                for pattern in exclude:
-                    # os.walk() supports trimming down the dnames list
-                    # by modifying it in-place,
-                    # to avoid unnecessary directory listings.
-                    dnames[:] = [
-                        x for x in dnames
-                        if
-                        not fnmatch.fnmatch(os.path.join(dirpath, x), pattern)
-                    ]
-                    fpaths = [
-                        x for x in fpaths if not fnmatch.fnmatch(x, pattern)
-                    ]
-                for f in fpaths:
-                    ext = os.path.splitext(f)[1][1:]
-                    if ext in extensions:
-                        out.append(f)
+            # the top level directories are walked in parallel,
+            # most of the time is spent waiting on the file system
+            directories = []
+            for entry in os.scandir(file):
+                path = os.path.join(file, entry.name)
+                if entry.is_dir():
+                    if not entry.is_symlink() and not is_excluded(exclude_regex, path):
+                        directories.append(path)
+                elif os.path.splitext(entry.name)[1][1:] in extensions and not is_excluded(exclude_regex, path):
+                    out.append(path)
+
+            if len(directories) > 1:
+                pool = ThreadPool(min(len(directories), multiprocessing.cpu_count()))
+                try:
+                    for files_in_dir in pool.map(partial(walk_files, extensions=extensions, exclude_regex=exclude_regex), directories):
+                        out.extend(files_in_dir)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for directory in directories:
+                    out.extend(walk_files(directory, extensions, exclude_regex))
         else:
             out.append(file)
     return out
 
 
+def list_changed_files(files, diff, extensions=None, exclude=None):
+    """Returns the files changed according to git that are located under one of the given paths,
+    together with the line ranges that changed in each of them."""
+    # only needed in diff mode, so this script can run on its own otherwise
+    import regis.git
+
+    if extensions is None:
+        extensions = []
+    if exclude is None:
+        exclude = []
+
+    exclude_regex = compile_excludes(exclude)
+    staged = diff == 'staged'
+    changed_files = regis.git.get_staged_files() if staged else regis.git.get_unstaged_files()
+    toplevel = regis.git.get_toplevel()
+    changed_files = [os.path.normpath(os.path.join(toplevel, file)) for file in changed_files]
+    roots = [(root, os.path.abspath(root)) for root in files]
+
+    # clang-format runs on the working tree, so the line numbers need to be the ones of the working tree.
+    # the staged hunks are line numbers in the index, which are off for files with unstaged changes as well,
+    # so for staged files the working tree is compared to HEAD instead.
+    # this also checks the unstaged changes of partially staged files.
+    changed_lines = regis.git.get_changed_lines('HEAD' if staged else None, files=changed_files)
+
+    line_ranges = {}
+    for file in changed_files:
+        if not os.path.isfile(file):
+            continue
+        # without line numbers (eg. there's no HEAD yet) the whole file is checked
+        if file not in changed_lines and not staged:
+            continue
+        root = next((root for root, abs_root in roots if file == abs_root or file.startswith(os.path.join(abs_root, ''))), None)
+        if root is None:
+            continue
+        if os.path.splitext(file)[1][1:] not in extensions:
+            continue
+        # excludes are matched against the same paths as list_files produces, relative to the given path
+        path = root if file == os.path.abspath(root) else os.path.join(root, os.path.relpath(file, os.path.abspath(root)))
+        if is_excluded(exclude_regex, path):
+            continue
+        line_ranges[path] = changed_lines.get(file, [])
+
+    return line_ranges
+
+
+def hash_file(path):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, 1 << 16), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class FormatCache:
+    """Remembers the content hash of every file that was last verified as formatted.
+    A file whose content and .clang-format file didn't change since then doesn't need to be formatted again.
+    The whole cache is invalidated when the clang-format version or the style changes."""
+
+    def __init__(self, path, version, style):
+        self.path = path
+        self.version = version
+        self.style = style or ''
+        self.files = {}
+        self._style_file_hashes = {}
+        self._style_file_per_dir = {}
+
+        try:
+            with io.open(path, 'r', encoding='utf-8') as f:
+                content = json.load(f)
+        except (EnvironmentError, ValueError):
+            return
+
+        if content.get('version') == self.version and content.get('style') == self.style:
+            self.files = content.get('files', {})
+
+    def _find_style_file(self, directory):
+        # clang-format uses the style file closest to the file it formats,
+        # in each directory .clang-format takes precedence over _clang-format
+        if directory not in self._style_file_per_dir:
+            style_files = [os.path.join(directory, name) for name in ('.clang-format', '_clang-format')]
+            style_file = next((path for path in style_files if os.path.isfile(path)), None)
+            if style_file is not None:
+                self._style_file_per_dir[directory] = style_file
+            else:
+                parent = os.path.dirname(directory)
+                self._style_file_per_dir[directory] = self._find_style_file(parent) if parent != directory else None
+        return self._style_file_per_dir[directory]
+
+    def _style_file_hash(self, file):
+        style_file = self._find_style_file(os.path.dirname(os.path.abspath(file)))
+        if style_file is None:
+            return ''
+        if style_file not in self._style_file_hashes:
+            self._style_file_hashes[style_file] = hash_file(style_file)
+        return self._style_file_hashes[style_file]
+
+    def _entry(self, file):
+        return {'hash': hash_file(file), 'style_file': self._style_file_hash(file)}
+
+    def is_formatted(self, file):
+        key = os.path.abspath(file)
+        try:
+            return self.files.get(key) == self._entry(file)
+        except EnvironmentError:
+            return False
+
+    def mark_formatted(self, file):
+        self.files[os.path.abspath(file)] = self._entry(file)
+
+    def save(self):
+        content = {'version': self.version, 'style': self.style, 'files': self.files}
+        # on a clean tree, the directory of the cache doesn't exist yet
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        with io.open(self.path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(content, indent=2))
+
+
 def make_diff(file, original, reformatted):
     return list(
         difflib.unified_diff(
@@ -115,8 +283,8 @@ class UnexpectedError(Exception):
 
 def run_clang_format_diff_wrapper(args, file):
     try:
-        ret = run_clang_format_diff(args, file)
-        return ret
+        outs, errs = run_clang_format_diff(args, file)
+        return file, outs, errs
     except DiffError:
         raise
     except Exception as e:
@@ -139,6 +307,10 @@ def run_clang_format_diff(args, file):
     if args.style:
         invocation.extend(['--style', args.style])
 
+    # in diff mode, only the changed lines get formatted
+    for first, last in args.line_ranges.get(file, []):
+        invocation.append('--lines={}:{}'.format(first, last))
+
     if args.dry_run:
         print(" ".join(invocation))
         return [], []
@@ -202,6 +374,100 @@ def run_clang_format_diff(args, file):
     return make_diff(file, original, outs), errs
 
 
+# clang-format --dry-run -Werror reports every violation as
+# <file>:<line>:<column>: error: code should be clang-formatted [-Wclang-format-violations]
+VIOLATION_REGEX = re.compile(r'^(.*):\d+:\d+: (?:error|warning): .*\[-Wclang-format-violations\]')
+
+# Maximum length of the files passed to a single clang-format invocation,
+# Windows doesn't allow command lines longer than 32768 characters
+MAX_BATCH_COMMAND_LENGTH = 30000
+
+
+def make_batches(files, njobs):
+    """Splits the files into a few batches per job"""
+    batch_size = max(1, -(-len(files) // (njobs * 4)))
+    batches = []
+    batch = []
+    batch_length = 0
+    for file in files:
+        if batch and (len(batch) >= batch_size or batch_length + len(file) > MAX_BATCH_COMMAND_LENGTH):
+            batches.append(batch)
+            batch = []
+            batch_length = 0
+        batch.append(file)
+        batch_length += len(file) + 1
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def run_clang_format_batch_wrapper(args, files):
+    try:
+        violations, errs = run_clang_format_batch(args, files)
+        return files, violations, errs
+    except DiffError:
+        raise
+    except Exception as e:
+        raise UnexpectedError('{}: {}: {}'.format(' '.join(files), e.__class__.__name__,
+                                                  e), e)
+
+
+def run_clang_format_batch(args, files):
+    """Runs a single clang-format process over multiple files.
+    When formatting in place, the files are formatted.
+    Otherwise clang-format only checks them, returning the files that violate the style."""
+    invocation = [args.clang_format_executable]
+    if args.in_place:
+        invocation.append('-i')
+    else:
+        invocation.extend(['--dry-run', '-Werror'])
+
+    if args.style:
+        invocation.extend(['--style', args.style])
+
+    invocation.extend(files)
+
+    if args.dry_run:
+        print(" ".join(invocation))
+        return [], []
+
+    try:
+        proc = subprocess.Popen(
+            invocation,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            encoding='utf-8')
+    except OSError as exc:
+        raise DiffError(
+            "Command '{}' failed to start: {}".format(
+                subprocess.list2cmdline(invocation), exc
+            )
+        )
+    outs, errs = proc.communicate()
+    errs = errs.splitlines(True)
+
+    violating_files = set()
+    for line in errs:
+        match = VIOLATION_REGEX.match(line)
+        if match:
+            violating_files.add(os.path.normpath(match.group(1)))
+    violations = [file for file in files if os.path.normpath(file) in violating_files]
+
+    if proc.returncode and not violations:
+        raise DiffError(
+            "Command '{}' returned non-zero exit status {}".format(
+                subprocess.list2cmdline(invocation), proc.returncode
+            ),
+            errs,
+        )
+
+    # the violations are reported with a diff afterwards, so their messages aren't forwarded
+    if violations:
+        errs = []
+    return violations, errs
+
+
 def bold_red(s):
     return '\x1b[1m\x1b[31m' + s + '\x1b[0m'
 
@@ -248,6 +514,51 @@ def print_trouble(prog, message, use_colors):
     print("{}: {} {}".format(prog, error_text, message), file=sys.stderr)
 
 
+def run_batches(args, files, njobs, cache, prog, colored_stderr):
+    """Runs clang-format over the files in batches.
+    Returns the exit status and the files that violate the style."""
+    retcode = ExitStatus.SUCCESS
+    batches = make_batches(files, njobs)
+    if njobs == 1:
+        it = (run_clang_format_batch_wrapper(args, batch) for batch in batches)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(njobs)
+        it = pool.imap_unordered(
+            partial(run_clang_format_batch_wrapper, args), batches)
+        pool.close()
+
+    violations = []
+    while True:
+        try:
+            batch, batch_violations, errs = next(it)
+        except StopIteration:
+            break
+        except DiffError as e:
+            print_trouble(prog, str(e), use_colors=colored_stderr)
+            retcode = ExitStatus.TROUBLE
+            sys.stderr.writelines(e.errs)
+        except UnexpectedError as e:
+            print_trouble(prog, str(e), use_colors=colored_stderr)
+            sys.stderr.write(e.formatted_traceback)
+            retcode = ExitStatus.TROUBLE
+            if pool:
+                pool.terminate()
+            break
+        else:
+            sys.stderr.writelines(errs)
+            violations.extend(batch_violations)
+            if batch_violations and retcode == ExitStatus.SUCCESS:
+                retcode = ExitStatus.DIFF
+            if cache and not args.dry_run:
+                for file in batch:
+                    if file not in batch_violations:
+                        cache.mark_formatted(file)
+    if pool:
+        pool.join()
+    return retcode, violations
+
+
 def run():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
@@ -304,6 +615,22 @@ def run():
     parser.add_argument(
         '--style',
         help='formatting style to apply (LLVM, Google, Chromium, Mozilla, WebKit)')
+    parser.add_argument(
+        '--diff',
+        choices=['staged', 'unstaged'],
+        help='only format the lines that changed in the staged or unstaged'
+        ' git changes of the files under the given paths')
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='pass many files to each clang-format process.'
+        ' Without --in-place, files are checked with --dry-run -Werror'
+        ' and diffs are only produced for the files violating the style')
+    parser.add_argument(
+        '--cache',
+        metavar='FILE',
+        help='skip files that are unchanged since they were last verified'
+        ' as formatted, keeping track of them in this file')
 
     args = parser.parse_args()
 
@@ -329,7 +656,7 @@ def run():
 
     version_invocation = [args.clang_format_executable, str("--version")]
     try:
-        subprocess.check_call(version_invocation, stdout=DEVNULL)
+        version = subprocess.check_output(version_invocation).decode('utf-8').strip()
     except subprocess.CalledProcessError as e:
         print_trouble(parser.prog, str(e), use_colors=colored_stderr)
         return ExitStatus.TROUBLE
@@ -348,11 +675,29 @@ def run():
     excludes = excludes_from_file(DEFAULT_CLANG_FORMAT_IGNORE)
     excludes.extend(args.exclude)
 
-    files = list_files(
-        args.files,
-        recursive=args.recursive,
-        exclude=excludes,
-        extensions=args.extensions.split(','))
+    args.line_ranges = {}
+    if args.diff:
+        args.line_ranges = list_changed_files(
+            args.files,
+            args.diff,
+            exclude=excludes,
+            extensions=args.extensions.split(','))
+        files = list(args.line_ranges.keys())
+        # clang-format only accepts line ranges for a single file at a time
+        args.batch = False
+    else:
+        files = list_files(
+            args.files,
+            recursive=args.recursive,
+            exclude=excludes,
+            extensions=args.extensions.split(','))
+
+    # the cache only holds files that are formatted as a whole
+    # which isn't the case in diff mode
+    cache = None
+    if args.cache and not args.dry_run and not args.diff:
+        cache = FormatCache(args.cache, version, args.style)
+        files = [file for file in files if not cache.is_formatted(file)]
 
     if not files:
         return
@@ -362,6 +707,15 @@ def run():
         njobs = multiprocessing.cpu_count() + 1
     njobs = min(len(files), njobs)
 
+    if args.batch:
+        retcode, files = run_batches(args, files, njobs, cache, parser.prog, colored_stderr)
+        # diffs are only produced for the files that violate the style
+        if args.in_place or args.dry_run or args.quiet or not files:
+            if cache:
+                cache.save()
+            return retcode
+        njobs = min(len(files), njobs)
+
     if njobs == 1:
         # execute directly instead of in a pool,
         # less overhead, simpler stacktraces
@@ -374,7 +728,7 @@ def run():
         pool.close()
     while True:
         try:
-            outs, errs = next(it)
+            file, outs, errs = next(it)
         except StopIteration:
             break
         except DiffError as e:
@@ -394,6 +748,9 @@ def run():
         else:
             sys.stderr.writelines(errs)
             if outs == []:
+                # the file is formatted now, only then it's safe to skip it next time
+                if cache:
+                    cache.mark_formatted(file)
                 continue
             if not args.quiet:
                 print_diff(outs, use_color=colored_stdout)
@@ -401,6 +758,8 @@ def run():
                 retcode = ExitStatus.DIFF
     if pool:
         pool.join()
+    if cache:
+        cache.save()
     return retcode
 
 
@@ -38,10 +38,10 @@ from __future__ import print_function
 
 import argparse
 import glob
+import hashlib
 import json
 import multiprocessing
 import os
-import queue
 import re
 import shutil
 import subprocess
@@ -54,13 +54,22 @@ import time
 import regis.util
 import regis.diagnostics
 import regis.rex_json
+import regis.memory_monitor
+import regis.compiler_db
+import regis.git
 
 try:
   import yaml
 except ImportError:
   yaml = None
 
-processed_files : dict[str, float] = {}
+if yaml:
+  # Prefer the libyaml bindings, they're a lot faster than the pure python implementation
+  try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+  except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
 active_pids = []
 
 def strtobool(val):
@@ -90,12 +99,6 @@ def find_compilation_database(path):
   return result
 
 
-def make_absolute(f, directory):
-  if os.path.isabs(f):
-    return f
-  return os.path.normpath(os.path.join(directory, f))
-
-
 def get_tidy_invocation(f, clang_tidy_binary, checks, tmpdir, build_path,
                         header_filter, allow_enabling_alpha_checkers,
                         extra_arg, extra_arg_before, quiet, config_file_path,
@@ -135,33 +138,85 @@ def get_tidy_invocation(f, clang_tidy_binary, checks, tmpdir, build_path,
       start.append('-config=' + config)
   for plugin in plugins:
       start.append('-load=' + plugin)
-  start.append(f)
+  # multiple files can be passed in at once to process them in a single clang-tidy process
+  if isinstance(f, list):
+    start.extend(f)
+  else:
+    start.append(f)
   return start
 
 
-def merge_replacement_files(tmpdir, mergefile):
-  """Merge all replacement files in a directory into a single file"""
-  # The fixes suggested by clang-tidy >= 4.0.0 are given under
-  # the top level key 'Diagnostics' in the output yaml files
-  mergekey = "Diagnostics"
-  merged=[]
-  for replacefile in glob.iglob(os.path.join(tmpdir, '*.yaml')):
-    content = yaml.safe_load(open(replacefile, 'r'))
+# A batch of files is filled up until its files are expected to take this many seconds
+batch_target_duration = 5.0
+batch_max_files = 32
+
+# The fixes suggested by clang-tidy >= 4.0.0 are given under
+# the top level key 'Diagnostics' in the output yaml files
+merge_key = "Diagnostics"
+
+# Number of replacement files a worker process loads at once
+merge_chunk_size = 64
+
+def _load_replacement_files(replacefiles):
+  """Loads the diagnostics of a chunk of replacement files.
+  Runs in a worker process, so diagnostics are returned already serialized,
+  together with a key identifying them so identical ones can be dropped."""
+  diagnostics = {}
+  for replacefile in replacefiles:
+    with open(replacefile, 'r') as f:
+      content = yaml.load(f, Loader=YamlLoader)
     if not content:
       continue # Skip empty files.
-    merged.extend(content.get(mergekey, []))
-
-  if merged:
-    # MainSourceFile: The key is required by the definition inside
-    # include/clang/Tooling/ReplacementsYaml.h, but the value
-    # is actually never used inside clang-apply-replacements,
-    # so we set it to '' here.
-    output = {'MainSourceFile': '', mergekey: merged}
-    with open(mergefile, 'w') as out:
-      yaml.safe_dump(output, out)
+
+    for diagnostic in content.get(merge_key, []):
+      # Headers get the same fix from every TU that includes them
+      key = hashlib.sha1(json.dumps(diagnostic, sort_keys=True).encode('utf-8')).hexdigest()
+      if key not in diagnostics:
+        diagnostics[key] = yaml.dump([diagnostic], Dumper=YamlDumper, default_flow_style=False)
+
+  return list(diagnostics.items())
+
+def merge_replacement_files(tmpdir, mergefile, jobs : int = 0):
+  """Merge all replacement files in a directory into a single file.
+  Files are loaded in parallel worker processes and identical diagnostics are only written once.
+  The merged file is streamed to disk, so the full document is never held in memory."""
+  replacefiles = sorted(glob.iglob(os.path.join(tmpdir, '*.yaml')))
+  chunks = [replacefiles[i:i + merge_chunk_size] for i in range(0, len(replacefiles), merge_chunk_size)]
+
+  if jobs == 0:
+    jobs = multiprocessing.cpu_count()
+  jobs = min(jobs, len(chunks))
+
+  pool = None
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs)
+    loaded_chunks = pool.imap(_load_replacement_files, chunks)
   else:
-    # Empty the file:
-    open(mergefile, 'w').close()
+    loaded_chunks = (_load_replacement_files(chunk) for chunk in chunks)
+
+  written_keys = set()
+  try:
+    with open(mergefile, 'w') as out:
+      for diagnostics in loaded_chunks:
+        for key, diagnostic in diagnostics:
+          if key in written_keys:
+            continue
+
+          if len(written_keys) == 0:
+            # MainSourceFile: The key is required by the definition inside
+            # include/clang/Tooling/ReplacementsYaml.h, but the value
+            # is actually never used inside clang-apply-replacements,
+            # so we set it to '' here.
+            out.write(f"MainSourceFile: ''\n{merge_key}:\n")
+
+          written_keys.add(key)
+          out.write(diagnostic)
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+
+  # If nothing got written, the file is left empty
 
 
 def find_binary(arg, name, build_path):
@@ -186,18 +241,85 @@ def find_binary(arg, name, build_path):
 def processed_filepath(build_path : str):
   return os.path.join(build_path, 'processed.json')
 
-def should_process_file(file : str, build_path : str, config_path : str):
-  global processed_files
+def load_processed_files(build_path : str):
+  """Loads the results of previous runs over a compilation database."""
+  processed_path = processed_filepath(build_path)
+  if os.path.exists(processed_path):
+    return regis.rex_json.load_file(processed_path) or {}
+
+  return {}
+
+def should_process_file(file : str, build_path : str, config_path : str, processed_files : dict):
   invocation_str = invocation_string(build_path, file, config_path)
   if invocation_str in processed_files:
-    was_successful = processed_files[invocation_str]['successful']
-    file_process_time = float(processed_files[invocation_str]['timestamp'])
+    was_successful = processed_files[invocation_str].get('successful', False)
+    file_process_time = float(processed_files[invocation_str].get('timestamp', 0))
     file_mod_time = os.path.getmtime(file)
 
     return not was_successful or file_mod_time > file_process_time
   
   return True
+
+def expected_duration(file : str, build_path : str, config_path : str, processed_files : dict):
+  """Returns how long clang-tidy took on the file last time.
+  Files we haven't seen before are expected to take the longest."""
+  invocation_str = invocation_string(build_path, file, config_path)
+  if invocation_str in processed_files and 'duration' in processed_files[invocation_str]:
+    return float(processed_files[invocation_str]['duration'])
+
+  return float('inf')
   
+def expected_memory(file : str, build_path : str, config_path : str, processed_files : dict):
+  """Returns the peak memory clang-tidy used on the file last time.
+  For files we haven't seen before, the average of all known files is used."""
+  invocation_str = invocation_string(build_path, file, config_path)
+  if invocation_str in processed_files and processed_files[invocation_str].get('peak_memory'):
+    return int(processed_files[invocation_str]['peak_memory'])
+
+  # peaks of 0 were recorded for processes that exited before they got sampled, they'd pull the average down
+  known_peaks = [entry['peak_memory'] for entry in processed_files.values() if entry.get('peak_memory')]
+  if len(known_peaks) == 0:
+    return 0
+
+  return int(sum(known_peaks) / len(known_peaks))
+
+def create_line_filter(changedLines : dict[str, list[tuple[int, int]]], files : list[str]):
+  """Creates the -line-filter argument so clang-tidy only reports diagnostics on the changed lines.
+  Diagnostics in files that aren't mentioned are suppressed by clang-tidy as well.
+  Only the given files are mentioned, to keep the command line short."""
+  wanted_files = set([os.path.normcase(file) for file in files])
+  line_filter = []
+  for file, lines in changedLines.items():
+    if os.path.normcase(file) in wanted_files:
+      line_filter.append({'name': file, 'lines': [[first, last] for first, last in lines]})
+
+  return json.dumps(line_filter)
+
+def select_changed_translation_units(files : list[str], database : regis.compiler_db.CompileDB, changedLines : dict[str, list[tuple[int, int]]]):
+  """Returns the files that changed themselves or include a header that changed
+  and the changed files that are part of those translation units"""
+  changed_files = set([os.path.normcase(file) for file in changedLines])
+  changed_headers = changed_files - set([os.path.normcase(file) for file in files])
+  entries = {os.path.normcase(entry.file): entry for entry in database.entries}
+  scanner = regis.compiler_db.IncludeScanner()
+
+  selected_files = []
+  affected_files = set()
+  for file in files:
+    key = os.path.normcase(file)
+    included_changes = []
+    if changed_headers and key in entries:
+      includes = scanner.find_includes(file, entries[key].include_dirs())
+      included_changes = [os.path.normcase(header) for header in includes if os.path.normcase(header) in changed_headers]
+
+    if key in changed_files or included_changes:
+      selected_files.append(file)
+      affected_files.update(included_changes)
+      if key in changed_files:
+        affected_files.add(key)
+
+  return selected_files, [file for file in changedLines if os.path.normcase(file) in affected_files]
+
 def apply_fixes(args, clang_apply_replacements_binary, tmpdir):
   """Calls clang-apply-fixes on a given directory."""
   invocation = [clang_apply_replacements_binary]
@@ -213,47 +335,207 @@ def apply_fixes(args, clang_apply_replacements_binary, tmpdir):
   regis.util.wait_for_process(proc)
   
 def invocation_string(build_path : str, file : str, config_path : str):
-  return build_path + ' - ' + config_path + ' - -' + (file)
-
-def run_tidy(args, clang_tidy_binary, tmpdir, build_path, queue, lock,
-             failed_files):
-  """Takes filenames out of queue and runs clang-tidy on them."""
+  return f'{build_path} - {config_path} - -{file}'
+
+def print_output(invocation : list[str], output : str, err : str):
+  """Default output callback, writes the output of a clang-tidy invocation to the console."""
+  sys.stdout.write(' '.join(invocation) + '\n' + output)
+  if len(err) > 0:
+    sys.stdout.flush()
+    sys.stderr.write(err)
+
+class TidyOptions():
+  """Options of a clang-tidy run over a single compilation database.
+  The attributes match the command line arguments of this script."""
+  def __init__(self, buildPath : str = None, clangTidyBinary : str = None, clangApplyReplacementsBinary : str = None,
+               checks : str = None, config : str = None, configFile : str = None,
+               headerFilter : str = None, lineFilter : str = None, files : list[str] = None,
+               fix : bool = False, format : bool = False, style : str = 'file', exportFixes : str = None,
+               useColor : bool = None, extraArg : list[str] = None, extraArgBefore : list[str] = None,
+               quiet : bool = False, plugins : list[str] = None, incremental : bool = False,
+               allowEnablingAlphaCheckers : bool = False, diffBase : str = None, batch : bool = False):
+    self.build_path = buildPath
+    self.clang_tidy_binary = clangTidyBinary
+    self.clang_apply_replacements_binary = clangApplyReplacementsBinary
+    self.checks = checks
+    self.config = config
+    self.config_file = configFile
+    self.header_filter = headerFilter
+    self.line_filter = lineFilter
+    self.files = files or ['.*']
+    self.fix = fix
+    self.format = format
+    self.style = style
+    self.export_fixes = exportFixes
+    self.use_color = useColor
+    self.extra_arg = extraArg or []
+    self.extra_arg_before = extraArgBefore or []
+    self.quiet = quiet
+    self.plugins = plugins or []
+    self.incremental = incremental
+    self.allow_enabling_alpha_checkers = allowEnablingAlphaCheckers
+    self.diff_base = diffBase
+    self.batch = batch
+
+class TidyFileResult():
+  """Result of running clang-tidy on a single file"""
+  def __init__(self, file : str, returnCode : int, output : str, errors : str, duration : float):
+    self.file = file
+    self.return_code = returnCode
+    self.output = output
+    self.errors = errors
+    self.duration = duration
+
+  def successful(self):
+    return self.return_code == 0
+
+class TidyResult():
+  """Result of a clang-tidy run over a single compilation database"""
+  def __init__(self, buildPath : str):
+    self.build_path = buildPath
+    self.return_code = 0
+    self.error = ''
+    self.file_results : dict[str, TidyFileResult] = {}
+    self.failed_files : list[str] = []
+    self.num_files_skipped = 0
+
+class CompileDbRun():
+  """A clang-tidy run over all the files of a single compilation database"""
+  def __init__(self, args, buildPath : str, clangTidyBinary : str, clangApplyReplacementsBinary : str, tmpdir : str):
+    self.args = args
+    self.build_path = buildPath
+    self.clang_tidy_binary = clangTidyBinary
+    self.clang_apply_replacements_binary = clangApplyReplacementsBinary
+    self.tmpdir = tmpdir
+    self.files : list[str] = []
+    self.processed_files : dict[str, dict] = {}
+    self.output_callback = print_output
+    self.line_filter = args.line_filter
+    self.entries : dict[str, regis.compiler_db.CompileDBEntry] = {}
+    self.result = TidyResult(buildPath)
+
+  def expected_duration(self, file : str):
+    return expected_duration(file, self.build_path, self.args.config_file, self.processed_files)
+
+  def expected_memory(self, file : str):
+    return expected_memory(file, self.build_path, self.args.config_file, self.processed_files)
+
+def record_file_result(run : CompileDbRun, name : str, returncode : int, output : str, err : str, duration : float, peakMemory : int):
+  """Stores the result of processing a file, must be called under the output lock"""
+  run.result.file_results[name] = TidyFileResult(name, returncode, output, err, duration)
+  if returncode != 0:
+    run.result.failed_files.append(name)
+  invocation_str = invocation_string(run.build_path, name, run.args.config_file)
+  processed_file = run.processed_files.setdefault(invocation_str, {})
+  processed_file['duration'] = duration
+
+  # a process that exited before its memory got sampled keeps the peak of last time
+  if peakMemory is not None:
+    processed_file['peak_memory'] = peakMemory
+
+  # a line filtered run only reported on some lines of the file,
+  # so the file still needs to be processed by the next full run
+  if run.line_filter is None:
+    processed_file['timestamp'] = time.time()
+    processed_file['successful'] = returncode == 0 # warnings are > 0, errors are < 0
+
+def run_tidy(tasks : list, lock, memoryMonitor : regis.memory_monitor.MemoryMonitor):
+  """Takes (run, filenames, expected memory) tasks out of the list and runs clang-tidy on them.
+  A task is only taken when there's enough memory available to run it."""
   while True:
-    name = queue.get()
-    invocation = get_tidy_invocation(name, clang_tidy_binary, args.checks,
-                                     tmpdir, build_path, args.header_filter,
+    task, slot = memoryMonitor.take(tasks, lambda task: task[2])
+    if task is None:
+      return
+
+    run, names, _ = task
+    args = run.args
+    invocation = get_tidy_invocation(names, run.clang_tidy_binary, args.checks,
+                                     run.tmpdir, run.build_path, args.header_filter,
                                      args.allow_enabling_alpha_checkers,
                                      args.extra_arg, args.extra_arg_before,
                                      args.quiet, args.config_file, args.config,
-                                     args.line_filter, args.use_color,
+                                     run.line_filter, args.use_color,
                                      args.plugins)
 
     try:
+      start_time = time.time()
       proc = subprocess.Popen(invocation, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      slot.attach(proc.pid)
       active_pids.append(proc.pid)
       output, err = proc.communicate()
       active_pids.remove(proc.pid)
+      duration = time.time() - start_time
+
+      # A failing batch can't tell us which of its files failed.
+      # So its files get processed again one by one, which attributes the failure to the right files.
+      # The fixes of the batch would conflict with the ones of the single files, so they're removed.
+      # The files are queued before the slot is released, so the other workers wait for them.
+      if proc.returncode != 0 and len(names) > 1:
+        if run.tmpdir is not None:
+          fixes_path = invocation[invocation.index('-export-fixes') + 1]
+          if os.path.exists(fixes_path):
+            os.remove(fixes_path)
+        memoryMonitor.put(tasks, [(run, [name], run.expected_memory(name)) for name in names])
+        memoryMonitor.release(slot)
+        continue
+
+      peak_memory = memoryMonitor.release(slot)
+
       if proc.returncode != 0:
         if proc.returncode < 0:
-          msg = "%s: terminated by signal %d\n" % (name, -proc.returncode)
+          msg = "%s: terminated by signal %d\n" % (' '.join(names), -proc.returncode)
           err += msg.encode('utf-8')
-        failed_files.append(name)
+      output = output.decode('utf-8')
+      err = err.decode('utf-8')
       with lock:
-        sys.stdout.write(' '.join(invocation) + '\n' + output.decode('utf-8'))
-        if len(err) > 0:
-          sys.stdout.flush()
-          sys.stderr.write(err.decode('utf-8'))
-        invocation_str = invocation_string(build_path, name, args.config_file)
-        processed_files[invocation_str] = {}
-        processed_files[invocation_str]['timestamp'] = time.time()
-        processed_files[invocation_str]['successful'] = proc.returncode == 0 # warnings are > 0, errors are < 0
+        run.output_callback(invocation, output, err)
+
+        # We don't know how long each file of a batch took,
+        # so the duration is split according to how long the files took last time
+        expected_durations = [run.expected_duration(name) for name in names]
+        if any(expected == float('inf') for expected in expected_durations):
+          expected_durations = [1.0 for _ in names]
+        total_expected_duration = sum(expected_durations) or 1.0
+        for name, expected in zip(names, expected_durations):
+          record_file_result(run, name, proc.returncode, output, err, duration * expected / total_expected_duration, peak_memory)
     except Exception as Ex:
       regis.diagnostics.log_err(f'exception occurred: {Ex}')
-    queue.task_done()
+      memoryMonitor.release(slot)
+
+def create_batches(run : CompileDbRun):
+  """Groups the files of a run that share the same compile command into batches.
+  Batches are filled up until the files are expected to take batch_target_duration seconds.
+  Files we don't have a duration for yet are processed on their own, so we learn their duration."""
+  groups : dict[tuple, list[str]] = {}
+  for name in run.files:
+    entry = run.entries.get(os.path.normcase(name))
+    key = (entry.directory, tuple(entry.flags())) if entry else (name,)
+    groups.setdefault(key, []).append(name)
+
+  batches : list[list[str]] = []
+  for files in groups.values():
+    batch : list[str] = []
+    batch_duration = 0.0
+    for name in files:
+      duration = run.expected_duration(name)
+      if duration == float('inf'):
+        batches.append([name])
+        continue
 
+      if batch and (batch_duration + duration > batch_target_duration or len(batch) >= batch_max_files):
+        batches.append(batch)
+        batch = []
+        batch_duration = 0.0
 
+      batch.append(name)
+      batch_duration += duration
 
-def run():
+    if batch:
+      batches.append(batch)
+
+  return batches
+
+def create_parser():
   parser = argparse.ArgumentParser(description='Runs clang-tidy over all files '
                                    'in a compilation database. Requires '
                                    'clang-tidy and clang-apply-replacements in '
@@ -323,9 +605,24 @@ def run():
                       action='append', default=[],
                       help='Load the specified plugin in clang-tidy.')
   parser.add_argument('-incremental', action='store_true', default=False, help='run incrementally, skip files already processed run and haven\'t changed since last run')
-
-  args = parser.parse_args()
-
+  parser.add_argument('-batch', action='store_true', default=False,
+                      help='process files sharing the same compile command in a single '
+                      'clang-tidy invocation, to save on clang-tidy\'s startup cost.')
+  parser.add_argument('-diff-base', dest='diff_base', default=None,
+                      help='only run on the files affected by the git diff against this '
+                      'revision and only report diagnostics on the changed lines. '
+                      'e.g. -diff-base=origin/main')
+  return parser
+
+def parse_arguments(argv : list[str] = None):
+  """Parses the command line arguments of the script.
+  argv can be passed in to set up a run from within another python script."""
+  return create_parser().parse_args(argv)
+
+def prepare_run(args):
+  """Finds the compilation database and the files to process for the given arguments.
+  args is either the parsed command line or a TidyOptions object.
+  Returns None if clang-tidy can't be run."""
   db_path = 'compile_commands.json'
 
   if args.build_path is not None:
@@ -334,23 +631,21 @@ def run():
     # Find our database
     build_path = find_compilation_database(db_path)
 
-  if args.incremental:
-    regis.diagnostics.log_info(f'Running incremental mode')
-    global processed_files
-    processed_path = processed_filepath(build_path)
-    if os.path.exists(processed_path):
-      processed_files = regis.rex_json.load_file(processed_path)
-    else:
-      processed_files = {}
-
-  clang_tidy_binary = find_binary(args.clang_tidy_binary, "clang-tidy",
-                                  build_path)
+  try:
+    clang_tidy_binary = find_binary(args.clang_tidy_binary, "clang-tidy",
+                                    build_path)
+
+    clang_apply_replacements_binary = None
+    if args.fix or (yaml and args.export_fixes):
+      clang_apply_replacements_binary = find_binary(
+        args.clang_apply_replacements_binary, "clang-apply-replacements",
+        build_path)
+  except SystemExit as ex:
+    print(ex, file=sys.stderr)
+    return None
 
   tmpdir = None
-  if args.fix or (yaml and args.export_fixes):
-    clang_apply_replacements_binary = find_binary(
-      args.clang_apply_replacements_binary, "clang-apply-replacements",
-      build_path)
+  if clang_apply_replacements_binary:
     tmpdir = tempfile.mkdtemp()
 
   try:
@@ -371,72 +666,103 @@ def run():
       subprocess.check_call(invocation)
   except:
     print("Unable to run clang-tidy.", file=sys.stderr)
-    sys.exit(1)
+    if tmpdir:
+      shutil.rmtree(tmpdir)
+    return None
 
-  # Load the database and extract all files.
-  database = json.load(open(os.path.join(build_path, db_path)))
-  files = set([make_absolute(entry['file'], entry['directory'])
-           for entry in database])
+  run = CompileDbRun(args, build_path, clang_tidy_binary, clang_apply_replacements_binary, tmpdir)
 
-  max_task = args.j
-  if max_task == 0:
-    max_task = multiprocessing.cpu_count()
+  # The previous results are always loaded, as their durations are used for scheduling
+  run.processed_files = load_processed_files(build_path)
+
+  # Load the database and extract all files.
+  database = regis.compiler_db.CompileDB(build_path)
+  run.entries = {os.path.normcase(entry.file): entry for entry in database.entries}
+  files = set([entry.file for entry in database.entries])
 
   # Build up a big regexy filter from all command line arguments.
   file_name_re = re.compile('|'.join(args.files))
+  files = [name for name in files if file_name_re.search(name)]
+
+  # In diff mode, we only look at the files affected by the diff
+  # and only report the diagnostics on the lines that changed
+  if args.diff_base:
+    changed_lines = regis.git.get_changed_lines(args.diff_base)
+    files, affected_files = select_changed_translation_units(files, database, changed_lines)
+    run.line_filter = create_line_filter(changed_lines, affected_files)
+
+  # the files selected by the diff are always processed, a translation unit that includes a changed header
+  # is older than its last run, but the diagnostics in the header haven't been reported yet
+  for name in files:
+    if not args.incremental or args.diff_base or should_process_file(name, build_path, args.config_file, run.processed_files):
+      run.files.append(name)
+    else:
+      run.result.num_files_skipped += 1
+
+  return run
+
+def schedule(runs : list[CompileDbRun], maxTask : int = 0, memoryMonitor : regis.memory_monitor.MemoryMonitor = None):
+  """Runs clang-tidy over the files of all runs using a single pool of workers.
+  Files that took the longest last time are scheduled first, so the long ones don't end up at the tail.
+  New clang-tidy processes are only launched when there's enough memory available for them,
+  based on the peak memory the file used last time."""
+  if maxTask == 0:
+    maxTask = multiprocessing.cpu_count()
+
+  if memoryMonitor is None:
+    memoryMonitor = regis.memory_monitor.MemoryMonitor()
+
+  tasks = []
+  for run in runs:
+    batches = create_batches(run) if run.args.batch else [[name] for name in run.files]
+    for names in batches:
+      expected_duration = sum(run.expected_duration(name) for name in names)
+      expected_memory = max(run.expected_memory(name) for name in names)
+      tasks.append((expected_duration, run, names, expected_memory))
+
+  tasks.sort(key=lambda task: task[0], reverse=True)
+  tasks = [(run, names, expected_memory) for _, run, names, expected_memory in tasks]
+
+  # Spin up a bunch of tidy-launching threads.
+  lock = threading.Lock()
+  threads : list[threading.Thread] = []
+  for _ in range(min(maxTask, len(tasks))):
+    t = threading.Thread(target=run_tidy, args=(tasks, lock, memoryMonitor))
+    t.daemon = True
+    t.start()
+    threads.append(t)
+
+  # Wait for all threads to be done.
+  for t in threads:
+    t.join()
+
+def kill_active_processes():
+  for pid in list(active_pids):
+    try:
+      os.kill(pid, 9)
+    except Exception as ex:
+      # this is a hack on Windows which can sometimes fail to kill a process
+      try:
+        subprocess.check_output("Taskkill /PID %d /F" % pid)
+      except Exception as ex:
+        pass
 
+def finish_run(run : CompileDbRun):
+  """Exports and applies the fixes of a run and saves its results.
+  Returns the TidyResult of the run."""
+  args = run.args
   return_code = 0
-  try:
-    # Spin up a bunch of tidy-launching threads.
-    task_queue = queue.Queue(max_task)
-    # List of files with a non-zero return code.
-    failed_files = []
-    lock = threading.Lock()
-    for _ in range(max_task):
-      t = threading.Thread(target=run_tidy,
-                           args=(args, clang_tidy_binary, tmpdir, build_path,
-                                 task_queue, lock, failed_files))
-      t.daemon = True
-      t.start()
-
-    # Fill the queue with files.
-    num_files_skipped = 0
-    for name in files:
-      if file_name_re.search(name):
-        if not args.incremental or should_process_file(name, build_path, args.config_file):
-          task_queue.put(name)
-        else:
-          num_files_skipped += 1
-
-    # Wait for all threads to be done.
-    task_queue.join()
-
-    regis.diagnostics.log_info(f'skipped {num_files_skipped} files')
-
-    if len(failed_files):
-      return_code = 1
 
-  except KeyboardInterrupt:
-    # This is a sad hack. Unfortunately subprocess goes
-    # bonkers with ctrl-c and we start forking merrily.
-    print('\nCtrl-C detected, goodbye.')
-    if tmpdir:
-      shutil.rmtree(tmpdir)
+  if args.incremental:
+    regis.diagnostics.log_info(f'skipped {run.result.num_files_skipped} files')
 
-    for pid in active_pids:
-      try:
-        os.kill(pid, 9)
-      except Exception as ex:
-        # this is a hack on Windows which can sometimes fail to kill a process
-        try:
-          subprocess.check_output("Taskkill /PID %d /F" % pid)
-        except Exception as ex:
-          pass
+  if len(run.result.failed_files):
+    return_code = 1
 
   if yaml and args.export_fixes:
     print('Writing fixes to ' + args.export_fixes + ' ...')
     try:
-      merge_replacement_files(tmpdir, args.export_fixes)
+      merge_replacement_files(run.tmpdir, args.export_fixes)
     except:
       print('Error exporting fixes.\n', file=sys.stderr)
       traceback.print_exc()
@@ -445,19 +771,59 @@ def run():
   if args.fix:
     print('Applying fixes ...')
     try:
-      apply_fixes(args, clang_apply_replacements_binary, tmpdir)
+      apply_fixes(args, run.clang_apply_replacements_binary, run.tmpdir)
     except:
       print('Error applying fixes.\n', file=sys.stderr)
       traceback.print_exc()
       return_code = 1
 
-  if tmpdir:
-    shutil.rmtree(tmpdir)
+  if run.tmpdir:
+    shutil.rmtree(run.tmpdir)
     
-  regis.rex_json.save_file(processed_filepath(build_path), processed_files)
+  regis.rex_json.save_file(processed_filepath(run.build_path), run.processed_files)
+
+  run.result.return_code = return_code
+  return run.result
+
+def run_clang_tidy(options : TidyOptions, outputCallback = print_output, maxTask : int = 0):
+  """Runs clang-tidy over all files in the compilation database of the options.
+  This doesn't spawn a python interpreter, so it can be called from any thread of the calling script.
+  outputCallback is called with the invocation, output and errors of each file.
+  Returns a TidyResult."""
+  run = prepare_run(options)
+  if run is None:
+    result = TidyResult(options.build_path)
+    result.return_code = 1
+    result.error = 'Unable to run clang-tidy.'
+    return result
+
+  run.output_callback = outputCallback
+  schedule([run], maxTask)
+  return finish_run(run)
+
+def run():
+  args = parse_arguments()
+
+  if args.incremental:
+    regis.diagnostics.log_info(f'Running incremental mode')
+
+  tidy_run = prepare_run(args)
+  if tidy_run is None:
+    sys.exit(1)
+
+  try:
+    schedule([tidy_run], args.j)
+  except KeyboardInterrupt:
+    # This is a sad hack. Unfortunately subprocess goes
+    # bonkers with ctrl-c and we start forking merrily.
+    print('\nCtrl-C detected, goodbye.')
+    kill_active_processes()
+    if tidy_run.tmpdir:
+      shutil.rmtree(tidy_run.tmpdir)
+    sys.exit(1)
 
-  sys.exit(return_code)
+  sys.exit(finish_run(tidy_run).return_code)
 
 
 if __name__ == '__main__':
-  run()
\ No newline at end of file
+  run()
@@ -9,12 +9,14 @@
 # ============================================
 
 import os
+import sys
 import argparse
 import regis.diagnostics
 import regis.subproc
 import regis.util
 import regis.required_tools
 import regis.rex_json
+import regis.run_clang_tidy
 import shutil
 
 clang_tidy_first_pass_filename = ".clang-tidy_first_pass"
@@ -25,12 +27,9 @@ settings = regis.rex_json.load_file(os.path.join(root, regis.util.settingsPathFr
 intermediate_folder = settings["intermediate_folder"]
 build_folder = settings["build_folder"]
 processes_in_flight_filename = os.path.join(root, intermediate_folder, build_folder, "ninja", "post_builds_in_flight.tmp")
+clang_format_cache_filename = os.path.join(root, intermediate_folder, build_folder, "clang_format_cache.json")
 project = ""
 
-def __quoted_path(path):
-  quote = "\""
-  return f"{quote}{path}{quote}"
-
 def __run_command(command):
   proc = regis.subproc.run(command)
   streamdata = proc.communicate()[0]
@@ -54,29 +53,40 @@ def run(projectName : str, compdb : str, srcRoot : str, bRunAllChecks : bool, re
     regis.diagnostics.log_info(f"Compiler db found at {compdb_path}")
 
     regis.diagnostics.log_info("Running clang-tidy - auto fixes")
-    cmd = f"py {__quoted_path(script_path)}/run_clang_tidy.py -clang-tidy-binary={__quoted_path(clang_tidy_path)} -clang-apply-replacements-binary={__quoted_path(clang_apply_replacements_path)} -config-file={__quoted_path(clang_config_file)} -p={__quoted_path(compdb)} -header-filter={headerFiltersRegex} -quiet -fix {regex}"
-    
-    if not bRebuild:
-      cmd += ' -incremental'
-    
-    proc = regis.util.run_subprocess_from_command(cmd)
-    rc = regis.util.wait_for_process(proc)
-
-    if rc != 0:
+    options = regis.run_clang_tidy.TidyOptions(
+      buildPath=compdb,
+      clangTidyBinary=clang_tidy_path,
+      clangApplyReplacementsBinary=clang_apply_replacements_path,
+      configFile=clang_config_file,
+      headerFilter=headerFiltersRegex,
+      quiet=True,
+      fix=True,
+      files=[regex] if regex else None,
+      incremental=not bRebuild)
+    result = regis.run_clang_tidy.run_clang_tidy(options)
+
+    if result.return_code != 0:
       raise Exception("clang-tidy auto fixes failed")
   
     if bRunAllChecks:
       clang_config_file = os.path.join(compdb, clang_tidy_second_pass_filename)
       regis.diagnostics.log_info("Running clang-tidy - all checks")  
-      cmd = f"py {__quoted_path(script_path)}/run_clang_tidy.py -clang-tidy-binary={__quoted_path(clang_tidy_path)} -clang-apply-replacements-binary={__quoted_path(clang_apply_replacements_path)} -config-file={__quoted_path(clang_config_file)} -p={__quoted_path(compdb)} -header-filter={headerFiltersRegex} -quiet {regex}"
-      rc = __run_command(cmd) # force clang compiler, as clang-tools expect it
+      options = regis.run_clang_tidy.TidyOptions(
+        buildPath=compdb,
+        clangTidyBinary=clang_tidy_path,
+        clangApplyReplacementsBinary=clang_apply_replacements_path,
+        configFile=clang_config_file,
+        headerFilter=headerFiltersRegex,
+        quiet=True,
+        files=[regex] if regex else None)
+      result = regis.run_clang_tidy.run_clang_tidy(options)
 
 
   else:
     regis.diagnostics.log_warn(f"No compiler db found at {compdb}")
 
   regis.diagnostics.log_info("Running clang-format")
-  rc = __run_command(f"py {__quoted_path(script_path)}/run_clang_format.py --clang-format-executable={__quoted_path(clang_format_path)} -r -i {srcRoot}")
+  rc = __run_command([sys.executable, os.path.join(script_path, "run_clang_format.py"), f"--clang-format-executable={clang_format_path}", f"--cache={clang_format_cache_filename}", "--batch", "-r", "-i", srcRoot])
 
   if rc != 0:
     raise Exception("clang-format failed")
@@ -0,0 +1,203 @@
+# ============================================
+#
+# Author: Nick De Breuck
+# Twitter: @nick_debreuck
+#
+# File: sanitizer_reports.py
+# Copyright (c) Nick De Breuck 2023
+#
+# ============================================
+
+# Sanitizers write their reports as plain text.
+# This parses them into findings, so the same issue hit by many tests
+# or many runs is only reported once.
+
+import os
+import re
+import hashlib
+import glob
+
+# the amount of frames at the top of the stack that identify a finding
+signature_depth = 5
+
+# ==1234==ERROR: AddressSanitizer: heap-use-after-free on address 0x602000000010 at pc ...
+# ==1234== ERROR: libFuzzer: deadly signal
+_asan_header_regex = re.compile(r'^==\d+==\s*ERROR:\s*(\w+Sanitizer|libFuzzer):\s*([\w\-]+)')
+# /path/to/file.cpp:10:5: runtime error: signed integer overflow: ...
+_ubsan_header_regex = re.compile(r'^(.+?:\d+(?::\d+)?): runtime error: (.*)$')
+# SUMMARY: AddressSanitizer: heap-use-after-free /path/to/file.cpp:10:5 in main
+_summary_regex = re.compile(r'^SUMMARY:\s*(\w+Sanitizer|libFuzzer):\s*(.*)$')
+#    #0 0x4f1b2c in main /path/to/file.cpp:10:5
+#    #1 0x7f2c9a in __libc_start_main (/lib/x86_64-linux-gnu/libc.so.6+0x21bf6)
+#    #0 0x4f1b2c  (/path/to/program+0x4f1b2c) (BuildId: 2a5e...)
+_frame_regex = re.compile(r'^\s*#(\d+)\s+(0x[0-9a-fA-F]+)(?:\s+in\s+(.*?))?\s*(?:\(([^()]+)\+(0x[0-9a-fA-F]+)\))?\s*(?:\(BuildId:\s*([0-9a-fA-F]+)\))?\s*$')
+_location_regex = re.compile(r'^(.+?):(\d+)(?::(\d+))?$')
+# frames of the sanitizer and fuzzer runtimes and the system libraries
+# these are the same for every finding, so they don't identify it
+_runtime_function_regex = re.compile(r'^(__sanitizer|__asan|__ubsan|__lsan|__msan|__interceptor|__interception|__libc_|fuzzer::|_start$)')
+_runtime_module_regex = re.compile(r'^(libc[.-]|libpthread|libdl|libstdc\+\+|libc\+\+|ld-linux|ntdll|kernel32|kernelbase|ucrtbase)', re.IGNORECASE)
+
+class StackFrame():
+  """A single frame of a sanitizer stack trace"""
+  def __init__(self, index : int, address : int, function : str = None, location : str = None, module : str = None, moduleOffset : int = None, buildId : str = None):
+    self.index = index
+    self.address = address
+    self.function = function
+    self.location = location
+    self.module = module
+    self.module_offset = moduleOffset
+    self.build_id = buildId
+
+  def is_symbolized(self):
+    return self.function is not None
+
+  def is_runtime(self):
+    """Returns true if the frame is part of the sanitizer or fuzzer runtime or a system library"""
+    if self.function and _runtime_function_regex.match(self.function):
+      return True
+    return self.module is not None and _runtime_module_regex.match(os.path.basename(self.module)) is not None
+
+  def key(self):
+    """What identifies the frame, independent of where the program got loaded"""
+    if self.function:
+      return self.function
+    if self.module:
+      return f"{os.path.basename(self.module)}+{hex(self.module_offset)}"
+    return hex(self.address)
+
+  def to_string(self):
+    text = f"#{self.index} {hex(self.address)}"
+    if self.function:
+      text += f" in {self.function}"
+    if self.location:
+      text += f" {self.location}"
+    if self.module:
+      text += f" ({self.module}+{hex(self.module_offset)})"
+    return text
+
+class SanitizerFinding():
+  """A single error reported by a sanitizer"""
+  def __init__(self, sanitizer : str, kind : str, logPath : str = None):
+    self.sanitizer = sanitizer
+    self.kind = kind
+    self.description = ""
+    self.summary = ""
+    self.frames : list[StackFrame] = []
+    self.log_path = logPath
+
+  def signature(self):
+    """Findings with the same signature are the same issue"""
+    hasher = hashlib.sha1(f"{self.sanitizer}:{self.kind}".encode('utf-8'))
+    for frame in [frame for frame in self.frames if not frame.is_runtime()][:signature_depth]:
+      hasher.update(frame.key().encode('utf-8'))
+    return hasher.hexdigest()
+
+  def top_frame(self):
+    return self.frames[0] if len(self.frames) > 0 else None
+
+  def to_string(self):
+    lines = [f"{self.sanitizer}: {self.kind}"]
+    if self.description:
+      lines.append(self.description)
+    lines.extend([f"    {frame.to_string()}" for frame in self.frames])
+    if self.log_path:
+      lines.append(f"see: {self.log_path}")
+    return "\n".join(lines)
+
+  def to_dict(self):
+    return {
+      "sanitizer": self.sanitizer,
+      "kind": self.kind,
+      "description": self.description,
+      "summary": self.summary,
+      "frames": [frame.to_string() for frame in self.frames],
+      "log_path": self.log_path,
+      "signature": self.signature()
+    }
+
+def parse_frame(line : str):
+  """Parse a single line of a stack trace, returns None if the line isn't a frame"""
+  match = _frame_regex.match(line)
+  if not match:
+    return None
+
+  index, address, symbol, module, module_offset, build_id = match.groups()
+  function = None
+  location = None
+  if symbol:
+    # the location is the last token, if it's a path with a line number
+    function = symbol
+    parts = symbol.rsplit(' ', 1)
+    if len(parts) == 2 and _location_regex.match(parts[1]):
+      function, location = parts
+
+  return StackFrame(int(index), int(address, 16), function, location, module, int(module_offset, 16) if module_offset else None, build_id)
+
+def parse_report(text : str, logPath : str = None):
+  """Parse the text of a sanitizer report into a list of findings"""
+  findings : list[SanitizerFinding] = []
+  finding = None
+  stack_done = False
+  for line in text.splitlines():
+    asan_match = _asan_header_regex.match(line)
+    ubsan_match = _ubsan_header_regex.match(line)
+    if asan_match:
+      finding = SanitizerFinding(asan_match.group(1), asan_match.group(2), logPath)
+      finding.description = line
+      findings.append(finding)
+      stack_done = False
+      continue
+
+    if ubsan_match:
+      finding = SanitizerFinding("UndefinedBehaviorSanitizer", ubsan_match.group(2).split(':')[0], logPath)
+      finding.description = line
+      findings.append(finding)
+      stack_done = False
+      continue
+
+    if finding is None:
+      continue
+
+    summary_match = _summary_regex.match(line)
+    if summary_match:
+      finding.summary = summary_match.group(2)
+      finding = None
+      continue
+
+    # only the first stack belongs to the error itself
+    # the ones after that are eg. where memory got allocated or freed
+    if stack_done:
+      continue
+
+    frame = parse_frame(line)
+    if frame:
+      if frame.index == 0 and len(finding.frames) > 0:
+        stack_done = True
+        continue
+      finding.frames.append(frame)
+    elif len(finding.frames) > 0:
+      stack_done = True
+
+  return findings
+
+def parse_log_files(logPathPrefix : str):
+  """Parse all log files written using the prefix as log_path, sanitizers append the pid to it"""
+  findings : list[SanitizerFinding] = []
+  for log_path in sorted(glob.glob(f"{glob.escape(logPathPrefix)}.*")):
+    with open(log_path, "r", errors="replace") as f:
+      findings.extend(parse_report(f.read(), log_path))
+
+  return findings
+
+def remove_log_files(logPathPrefix : str):
+  """Remove the logs of a previous run, so they don't get reported again"""
+  for log_path in glob.glob(f"{glob.escape(logPathPrefix)}.*"):
+    os.remove(log_path)
+
+def dedupe(findings : list[SanitizerFinding]):
+  """Group the findings by signature, returns a dict of signature -> list of findings"""
+  unique_findings : dict[str, list[SanitizerFinding]] = {}
+  for finding in findings:
+    unique_findings.setdefault(finding.signature(), []).append(finding)
+
+  return unique_findings
@@ -0,0 +1,159 @@
+# ============================================
+#
+# Author: Nick De Breuck
+# Twitter: @nick_debreuck
+#
+# File: symbolizer.py
+# Copyright (c) Nick De Breuck 2023
+#
+# ============================================
+
+# Sanitizers and fuzzers launch llvm-symbolizer for every process that reports an error.
+# When a lot of runs report the same stacks, that's a lot of work being done over and over again.
+# Instead, reports are written unsymbolized (symbolize=0) and symbolized here.
+# A single llvm-symbolizer process is kept alive per binary
+# and every address that's been looked up is cached, keyed by the build id of the binary.
+
+import os
+import shutil
+import hashlib
+import threading
+import subprocess
+import regis.rex_json
+import regis.diagnostics
+import regis.required_tools
+
+from pathlib import Path
+
+def find_symbolizer():
+  """llvm-symbolizer comes with the same llvm installation as llvm-cov, if it's not configured explicitly"""
+  tool_paths_dict = regis.required_tools.tool_paths_dict
+  if "llvm_symbolizer_path" in tool_paths_dict:
+    return tool_paths_dict["llvm_symbolizer_path"]
+
+  if "llvm_cov_path" in tool_paths_dict:
+    llvm_cov_path = Path(tool_paths_dict["llvm_cov_path"])
+    symbolizer_path = os.path.join(llvm_cov_path.parent, f"llvm-symbolizer{llvm_cov_path.suffix}")
+    if os.path.exists(symbolizer_path):
+      return symbolizer_path
+
+  return shutil.which("llvm-symbolizer")
+
+class _ModuleSymbolizer():
+  """A llvm-symbolizer process that answers the lookups of a single binary"""
+  def __init__(self, symbolizerPath : str, module : str):
+    self.proc = subprocess.Popen([symbolizerPath, f"--obj={module}", "--no-inlines", "--demangle"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1)
+    self.lock = threading.Lock()
+
+  def lookup(self, offset : int):
+    """Returns the function and location of an offset in the binary"""
+    with self.lock:
+      # llvm-symbolizer answers every address with the function name and location, followed by an empty line
+      self.proc.stdin.write(f"{hex(offset)}\n")
+      lines = []
+      while True:
+        line = self.proc.stdout.readline()
+        if line == "" or line == "\n":
+          break
+        lines.append(line.rstrip('\n'))
+
+    function = lines[0] if len(lines) > 0 and lines[0] != "??" else None
+    location = lines[1] if len(lines) > 1 and not lines[1].startswith("??") else None
+    return function, location
+
+  def close(self):
+    self.proc.stdin.close()
+    self.proc.wait()
+
+class Symbolizer():
+  """Symbolizes the frames of sanitizer reports"""
+  def __init__(self, cacheDir : str, symbolizerPath : str = None):
+    self.cache_dir = cacheDir
+    self.symbolizer_path = symbolizerPath or find_symbolizer()
+    self._modules : dict[str, _ModuleSymbolizer] = {}
+    self._module_keys : dict[str, str] = {}
+    self._caches : dict[str, dict[str, list]] = {}
+    self._dirty_caches = set()
+    self._lock = threading.Lock()
+
+    if self.symbolizer_path is None:
+      regis.diagnostics.log_warn("llvm-symbolizer not found, sanitizer reports won't be symbolized")
+
+  def _module_key(self, module : str, buildId : str):
+    """Binaries are identified by their build id. if there's none, the hash of the binary is used"""
+    if buildId:
+      return buildId
+
+    if module not in self._module_keys:
+      hasher = hashlib.sha1()
+      with open(module, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+          hasher.update(chunk)
+      self._module_keys[module] = hasher.hexdigest()
+
+    return self._module_keys[module]
+
+  def _cache(self, key : str):
+    if key not in self._caches:
+      cache_path = os.path.join(self.cache_dir, f"{key}.json")
+      self._caches[key] = (regis.rex_json.load_file(cache_path) if os.path.exists(cache_path) else None) or {}
+
+    return self._caches[key]
+
+  def _module_symbolizer(self, module : str):
+    if module not in self._modules:
+      self._modules[module] = _ModuleSymbolizer(self.symbolizer_path, module)
+
+    return self._modules[module]
+
+  def symbolize_frame(self, frame):
+    """Fill in the function and location of an unsymbolized frame"""
+    if frame.is_symbolized() or frame.module is None or frame.module_offset is None:
+      return
+
+    if not os.path.exists(frame.module):
+      return
+
+    with self._lock:
+      key = self._module_key(frame.module, frame.build_id)
+      cache = self._cache(key)
+      offset = hex(frame.module_offset)
+      if offset not in cache:
+        if self.symbolizer_path is None:
+          return
+        module_symbolizer = self._module_symbolizer(frame.module)
+      else:
+        module_symbolizer = None
+
+    if module_symbolizer is not None:
+      function, location = module_symbolizer.lookup(frame.module_offset)
+      with self._lock:
+        cache[offset] = [function, location]
+        self._dirty_caches.add(key)
+
+    frame.function, frame.location = cache[offset]
+
+  def symbolize_findings(self, findings : list):
+    """Symbolize all frames of the findings, this should happen before they're deduplicated"""
+    for finding in findings:
+      for frame in finding.frames:
+        self.symbolize_frame(frame)
+
+  def save(self):
+    """Save the lookups that were added to the caches"""
+    os.makedirs(self.cache_dir, exist_ok=True)
+    for key in self._dirty_caches:
+      regis.rex_json.save_file(os.path.join(self.cache_dir, f"{key}.json"), self._caches[key])
+    self._dirty_caches.clear()
+
+  def close(self):
+    self.save()
+    for module_symbolizer in self._modules.values():
+      module_symbolizer.close()
+    self._modules.clear()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
@@ -9,12 +9,20 @@
 # ============================================
 
 import os
+import sys
 import threading
 import time
 import threading
 import subprocess
 import re
 import shutil
+import hashlib
+import shlex
+import glob
+import itertools
+import tempfile
+import psutil
+import collections
 import regis.required_tools
 import regis.util
 import regis.task_raii_printing
@@ -24,9 +32,18 @@ import regis.diagnostics
 import regis.generation
 import regis.build
 import regis.dir_watcher
+import regis.run_clang_tidy
+import regis.memory_monitor
+import regis.compiler_db
+import regis.git
+import regis.sanitizer_reports
+import regis.symbolizer
+import regis.crash_triage
+import regis.corpus_store
 
 from pathlib import Path
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from requests.structures import CaseInsensitiveDict
 from enum import Enum, auto
 
@@ -36,6 +53,7 @@ settings = regis.rex_json.load_file(os.path.join(root_path, regis.util.settingsP
 _pass_results = {}
 
 iwyu_intermediate_dir = "iwyu"
+iwyu_cache_dir = "iwyu_cache"
 clang_tidy_intermediate_dir = "clang_tidy"
 unit_tests_intermediate_dir = "unit_tests"
 coverage_intermediate_dir = "coverage"
@@ -43,6 +61,15 @@ asan_intermediate_dir = "asan"
 ubsan_intermediate_dir = "ubsan"
 fuzzy_intermediate_dir = "fuzzy"
 auto_test_intermediate_dir = "auto_test"
+sanitizer_logs_dir = "sanitizers"
+symbolizer_cache_dir = "symbolizer_cache"
+fuzzy_artifacts_dir = "fuzzy_artifacts"
+fuzzy_corpus_store_dir = "fuzzy_corpus_store"
+runnable_output_dir = "runnables"
+runnable_output_buffer_lines = 200 # the amount of lines of output kept in memory for every runnable
+runnable_output_tail_lines = 50 # the amount of lines printed when a runnable fails
+_runnable_ids = itertools.count()
+_output_lock = threading.Lock()
 
 def get_pass_results():
   return _pass_results
@@ -67,50 +94,100 @@ def _symbolic_print(line, filterLines : bool = False):
   elif not filterLines:
     regis.diagnostics.log_no_color(line)
 
-def _default_output_callback(pid, output, isStdErr, filterLines):
-  logs_dir = os.path.join(settings["intermediate_folder"], settings["logs_folder"])
-  filename = f"output_{pid}.log"
-  if isStdErr:
-    filename = f"errors_{pid}.log"
-
-  filepath = os.path.join(logs_dir, filename)
-  if os.path.exists(filepath):
-    os.remove(filepath)
-  elif not os.path.exists(logs_dir):
-    os.makedirs(logs_dir)
-
-  with open(filepath, "a+") as f:
+def _get_coverage_rawdata_filename(program : str):
+  # %p and %m make sure parallel runs and different programs don't overwrite each other's raw data
+  return f"{Path(program).stem}-%p-%m.profraw"
+
+def _get_coverage_dir(project : str, testType : str):
+  """The directory holding the raw coverage data of all runs of a type of test (eg. unit tests) of a project.
+  Every type of test has its own directory, so they don't remove each other's data"""
+  return os.path.join(root_path, settings["intermediate_folder"], settings["build_folder"], coverage_intermediate_dir, project, testType)
+
+def _get_coverage_dirs(project : str):
+  """The coverage directories of all types of tests that ran on a project"""
+  project_dir = os.path.join(root_path, settings["intermediate_folder"], settings["build_folder"], coverage_intermediate_dir, project)
+  if not os.path.isdir(project_dir):
+    return []
+  return [os.path.join(project_dir, test_type) for test_type in sorted(os.listdir(project_dir)) if os.path.isdir(os.path.join(project_dir, test_type))]
+
+def _prepare_coverage_dir(project : str, testType : str):
+  """Remove the raw coverage data of previous runs of a type of test of a project.
+  Only call this for runs with coverage enabled, test_combined_coverage uses the data of the last coverage run"""
+  coverage_dir = _get_coverage_dir(project, testType)
+  if os.path.exists(coverage_dir):
+    shutil.rmtree(coverage_dir)
+  os.makedirs(coverage_dir)
+  return coverage_dir
+
+def _create_coverage_reports(coverageRuns : list[tuple[list[str], str]]):
+  with regis.task_raii_printing.TaskRaiiPrint("creating coverage reports"):
+    # the json summary is needed for the full coverage gate
+    report_kinds = regis.code_coverage.get_report_kinds()
+    if "json_summary" not in report_kinds:
+      report_kinds = report_kinds + ["json_summary"]
 
-    for line in iter(output.readline, b''):
-      new_line : str = line.decode('UTF-8')
-      if new_line.endswith('\n'):
-        new_line = new_line.removesuffix('\n')
+    return regis.code_coverage.create_reports(coverageRuns, report_kinds)
 
-      _symbolic_print(new_line, filterLines)      
-      f.write(f"{new_line}\n")
+def _parse_coverage_report(indexedFile):
+  with regis.task_raii_printing.TaskRaiiPrint("parsing coverage reports"):
+      summary_filename = regis.code_coverage.get_coverage_summary_filename(indexedFile)
+      return regis.code_coverage.check_coverage(summary_filename)
+
+def _parse_diff_coverage(programs : list[str], indexedFile : str, diffBase : str):
+  with regis.task_raii_printing.TaskRaiiPrint(f"checking coverage of lines changed since {diffBase}"):
+    changed_lines = regis.git.get_changed_lines(diffBase)
+    return regis.code_coverage.check_diff_coverage(programs, indexedFile, changed_lines)
+
+def _process_coverage(name : str, coverageDirs : list[str], diffBase : str = None):
+  """Merge all raw coverage data found in the coverage directories, create a single report for it and check its coverage.
+  Every coverage directory lists the programs that wrote raw data into it in a programs.json file.
+  If a diff base is given, only the coverage of the lines changed since then is checked"""
+  programs : list[str] = []
+  rawdata_files : list[str] = []
+  for coverage_dir in coverageDirs:
+    programs_path = os.path.join(coverage_dir, "programs.json")
+    if not os.path.exists(programs_path):
+      continue
+
+    programs.extend([program for program in regis.rex_json.load_file(programs_path) if program not in programs])
+    rawdata_files.extend(_find_files(coverage_dir, lambda file: file.endswith(".profraw")))
+
+  if len(rawdata_files) == 0:
+    # coverage programs that ran without writing any raw data point to broken instrumentation
+    if len(programs) > 0:
+      regis.diagnostics.log_err(f"no coverage raw data found for {name}, while {len(programs)} coverage program(s) ran. is LLVM_PROFILE_FILE set up correctly?")
+      return 1
+    return 0
 
-    regis.diagnostics.log_info(f"full output saved to {filepath}")
+  with regis.task_raii_printing.TaskRaiiPrint(f"merging coverage data of {name}"):
+    indexed_file = regis.code_coverage.merge_rawdata(rawdata_files, name, programs)
+    if indexed_file is None:
+      return 1
 
-def _get_coverage_rawdata_filename(program : str):
-  return f"{Path(program).stem}.profraw"
+  # in diff mode, only the changed files are exported and checked, the full reports aren't needed
+  if diffBase is not None:
+    return _parse_diff_coverage(programs, indexed_file, diffBase)
 
-def _create_coverage_report(program, indexedFile):
-  with regis.task_raii_printing.TaskRaiiPrint("creating coverage reports"):
+  rc = _create_coverage_reports([(programs, indexed_file)])
+  if rc != 0:
+    return rc
 
-    if Path(program).stem != Path(indexedFile).stem:
-      regis.diagnostics.log_err(f"program stem doesn't match coverage file stem: {Path(program).stem} != {Path(indexedFile).stem}")
-      return 1
+  rc |= _parse_coverage_report(indexed_file)
+  return rc
 
-    regis.code_coverage.create_line_oriented_report(program, indexedFile)
-    regis.code_coverage.create_file_level_summary(program, indexedFile)
-    regis.code_coverage.create_lcov_report(program, indexedFile)
+def _process_project_coverage(project : str, testType : str, runnables : list, diffBase : str = None):
+  """Create the combined coverage report of all runs of a type of test of a project"""
+  programs = []
+  for runnable in runnables:
+    if runnable.type == RunnableType.Coverage and runnable.program not in programs:
+      programs.append(runnable.program)
 
-  return 0
+  if len(programs) == 0:
+    return 0
 
-def _parse_coverage_report(indexedFile):
-  with regis.task_raii_printing.TaskRaiiPrint("parsing coverage reports"):
-      report_filename = regis.code_coverage.get_file_level_summary_filename(indexedFile)
-      return regis.code_coverage.parse_file_summary(report_filename)
+  coverage_dir = _get_coverage_dir(project, testType)
+  regis.rex_json.save_file(os.path.join(coverage_dir, "programs.json"), programs)
+  return _process_coverage(f"{project}_{testType}", [coverage_dir], diffBase)
 
 class RunnableType(Enum):
   Default = 0,
@@ -118,7 +195,7 @@ class RunnableType(Enum):
   Sanitizer = auto(),
 
 class Runnable():
-  def __init__(self, runnableDict, args = [], enableAsan : bool = False, enableUbsan : bool = False):
+  def __init__(self, runnableDict, args = [], enableAsan : bool = False, enableUbsan : bool = False, coverageDir : str = None, verbose : bool = False):
     self.program = runnableDict['Program']
     self.type = RunnableType[runnableDict['RunnableType']]
     self.args = args
@@ -127,6 +204,18 @@ class Runnable():
     self.finished = False
     self.enable_asan = enableAsan
     self.enable_ubsan = enableUbsan
+    self.coverage_dir = coverageDir
+    self.findings : list[regis.sanitizer_reports.SanitizerFinding] = []
+    self.verbose = verbose
+
+    # every runnable gets its own id, so runnables of the same program can run at the same time
+    self.id = next(_runnable_ids)
+
+    # the output is captured instead of written to the terminal, the last lines are kept in memory
+    # and all of it is saved to a log file. it's only printed when the runnable fails
+    self.output_tail = collections.deque(maxlen=runnable_output_buffer_lines)
+    self.num_output_lines = 0
+    self.output_log_path = os.path.join(_runnable_output_logs_dir(), f"{Path(self.program).stem}_{self.id}.log")
   
   def run(self):
     regis.diagnostics.log_info(f"running: {Path(self.program).name}")
@@ -145,6 +234,10 @@ class Runnable():
       rc = self._run_sanitizer()
             
     self.finished = True
+
+    if rc != 0 and not self.verbose:
+      self._print_output_tail(rc)
+
     return rc
 
   def terminate(self):
@@ -154,64 +247,307 @@ class Runnable():
     self.terminated = True
     self.finished = True
 
-  def _default_run(self):
-    self.proc = regis.util.run_subprocess(self.program, self.args)
+  def _start(self, env : dict = None):
+    """Launch the program, the environment is passed to the child only so runnables can run in parallel"""
+    args = self.args
+    if isinstance(args, str):
+      args = shlex.split(args, posix=not regis.util.is_windows())
+
+    os.makedirs(Path(self.output_log_path).parent, exist_ok=True)
+    self.proc = subprocess.Popen([self.program] + list(args), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    # the runnable could've been terminated before it even started
+    if self.terminated:
+      self.proc.terminate()
+
+    with open(self.output_log_path, "wb") as log_file:
+      for line in self.proc.stdout:
+        log_file.write(line)
+        text = line.decode('utf-8', errors='replace').rstrip('\r\n')
+        self.output_tail.append(text)
+        self.num_output_lines += 1
+        if self.verbose:
+          with _output_lock:
+            regis.diagnostics.log_no_color(f"[{Path(self.program).name}] {text}")
+
     return regis.util.wait_for_process(self.proc)
 
-  def _run_coverage(self):
-    # First run the program
-    coverage_rawdata_filename = _get_coverage_rawdata_filename(self.program)
-    raw_data_file = os.path.join(Path(self.program).parent, coverage_rawdata_filename)
-    os.environ["LLVM_PROFILE_FILE"] = raw_data_file # this is what llvm uses to set the raw data filename for the coverage data
-    self.proc = regis.util.run_subprocess(self.program, self.args)
-    rc = regis.util.wait_for_process(self.proc)
+  def _print_output_tail(self, rc : int):
+    """Print the last lines of output of a failed runnable, the full output is in its log file"""
+    tail = list(self.output_tail)[-runnable_output_tail_lines:]
 
-    # Then index the raw data file
-    indexed_file = regis.code_coverage.create_index_rawdata(raw_data_file)
+    # lock, so the output of runnables failing at the same time doesn't get mixed
+    with _output_lock:
+      regis.diagnostics.log_err(f"{self.program} exited with {rc}, last {len(tail)} of {self.num_output_lines} lines of output:")
+      for line in tail:
+        regis.diagnostics.log_no_color(line)
+      regis.diagnostics.log_err(f"full output: {self.output_log_path}")
 
-    # next create the coverage report
-    rc |= _create_coverage_report(self.program, indexed_file)
+  def _default_run(self):
+    return self._start()
 
-    # finally, parse the coverage report
-    rc |= _parse_coverage_report(indexed_file)
+  def _run_coverage(self):
+    # First run the program
+    coverage_rawdata_filename = _get_coverage_rawdata_filename(self.program)
+    raw_data_file = os.path.join(self.coverage_dir or Path(self.program).parent, coverage_rawdata_filename)
+    env = os.environ.copy()
+    env["LLVM_PROFILE_FILE"] = raw_data_file # this is what llvm uses to set the raw data filename for the coverage data
+    rc = self._start(env)
 
+    # the raw data of all runs of a project is merged and reported on afterwards, see _process_project_coverage
     return rc
   
+  def _sanitizer_log_prefix(self, sanitizer : str):
+    """The sanitizers append the pid to the log path, so every process gets its own log file"""
+    log_folder = os.path.join(root_path, settings["intermediate_folder"], settings["logs_folder"], sanitizer_logs_dir)
+    return os.path.join(log_folder, f"{Path(self.program).stem}_{self.id}_{sanitizer}").replace('\\', '/')
+
   def _run_sanitizer(self):
     rc = 0
 
     # ASAN_OPTIONS common flags: https://github.com/google/sanitizers/wiki/SanitizerCommonFlags
     # ASAN_OPTIONS flags: https://github.com/google/sanitizers/wiki/AddressSanitizerFlags
     # UBSAN_OPTIONS common flags: https://github.com/google/sanitizers/wiki/SanitizerCommonFlags
-    log_folder = os.path.join(root_path, settings["intermediate_folder"], settings["logs_folder"])
+    env = os.environ.copy()
+    log_prefixes = []
     
-    asan_log_path = ''
     if self.enable_asan:
-      asan_log_path = os.path.join(log_folder, 'asan.log').replace('\\', '/')
-      asan_options = f"print_stacktrace=1:log_path=\"{asan_log_path}\""
-      os.environ["ASAN_OPTIONS"] = asan_options # print callstacks and save to log file
+      asan_log_prefix = self._sanitizer_log_prefix('asan')
+      env["ASAN_OPTIONS"] = f"print_stacktrace=1:symbolize=0:log_path=\"{asan_log_prefix}\"" # print callstacks and save to log file, they get symbolized afterwards
+      log_prefixes.append(asan_log_prefix)
 
-    ubsan_log_path = ''
     if self.enable_ubsan:
-      ubsan_log_path = os.path.join(log_folder, 'ubsan.log').replace('\\', '/')
-      ubsan_options = f"print_stacktrace=1:log_path=\"{ubsan_log_path}\""
-      os.environ["UBSAN_OPTIONS"] = ubsan_options # print callstacks and save to log file
+      ubsan_log_prefix = self._sanitizer_log_prefix('ubsan')
+      env["UBSAN_OPTIONS"] = f"print_stacktrace=1:symbolize=0:log_path=\"{ubsan_log_prefix}\"" # print callstacks and save to log file, they get symbolized afterwards
+      log_prefixes.append(ubsan_log_prefix)
+
+    # logs of a previous run would otherwise fail this one
+    for log_prefix in log_prefixes:
+      os.makedirs(Path(log_prefix).parent, exist_ok=True)
+      regis.sanitizer_reports.remove_log_files(log_prefix)
     
-    self.proc = regis.util.run_subprocess(self.program, self.args)
-    new_rc = regis.util.wait_for_process(self.proc)
-    if new_rc != 0 or (asan_log_path and os.path.exists(asan_log_path)) or (ubsan_log_path and os.path.exists(ubsan_log_path)):
+    new_rc = self._start(env)
+
+    log_files = []
+    for log_prefix in log_prefixes:
+      log_files.extend(glob.glob(f"{glob.escape(log_prefix)}.*"))
+      self.findings.extend(regis.sanitizer_reports.parse_log_files(log_prefix))
+
+    if new_rc != 0 or len(log_files) > 0:
       regis.diagnostics.log_err(f"sanitization failed for {self.program}") # use full path to avoid ambiguity
-      regis.diagnostics.log_err(f"for more info regarding asan, please check: {asan_log_path}")
-      regis.diagnostics.log_err(f"for more info regarding ubsan, please check: {ubsan_log_path}")
+      for log_file in log_files:
+        regis.diagnostics.log_err(f"for more info, please check: {log_file}")
       new_rc = 1
     rc |= new_rc
 
     return rc
 
+def _runnable_output_logs_dir():
+  """Every process writes its logs to its own directory, so jobs running at the same time keep their logs apart"""
+  return os.path.join(root_path, settings["intermediate_folder"], settings["logs_folder"], runnable_output_dir, str(os.getpid()))
+
+def _clear_runnable_output_logs():
+  """Remove the output logs of previous jobs in this process and those of processes that are no longer running.
+  The logs of jobs still running in other processes are left alone"""
+  logs_root = Path(_runnable_output_logs_dir()).parent
+  if not os.path.exists(logs_root):
+    return
+
+  for entry in os.scandir(logs_root):
+    if not entry.is_dir() or not entry.name.isdigit():
+      continue
+    pid = int(entry.name)
+    if pid == os.getpid() or not psutil.pid_exists(pid):
+      # files can still be open by a process that is exiting, those are cleaned up next time
+      shutil.rmtree(entry.path, ignore_errors=True)
+
+def _run_runnables(runnables : list[Runnable], singleThreaded : bool, timeoutInSeconds : int = None):
+  """Run the runnables on all cores, unless single threaded. Returns their return codes in the same order"""
+  def _run(runnable : Runnable):
+    if timeoutInSeconds is None:
+      return runnable.run()
+
+    timer = threading.Timer(timeoutInSeconds, runnable.terminate)
+    timer.start()
+    rc = runnable.run()
+    timer.cancel()
+    return rc
+
+  if singleThreaded or len(runnables) <= 1:
+    return [_run(runnable) for runnable in runnables]
+
+  with ThreadPool(min(len(runnables), os.cpu_count())) as pool:
+    return pool.map(_run, runnables)
+
+def _symbolizer_cache_dir():
+  return os.path.join(root_path, settings["intermediate_folder"], settings["build_folder"], symbolizer_cache_dir)
+
+def _corpus_store_dir():
+  # the store lives outside the fuzzy intermediates, so it survives cleaning them
+  return os.path.join(root_path, settings["intermediate_folder"], settings["build_folder"], fuzzy_corpus_store_dir)
+
+def _report_sanitizer_findings(project : str, runnables : list[Runnable]):
+  """Print every unique sanitizer finding once and save all of them to a json file"""
+  findings = []
+  for runnable in runnables:
+    findings.extend(runnable.findings)
+
+  if len(findings) == 0:
+    return
+
+  # the reports are written unsymbolized, which is a lot faster when many runs hit the same stacks
+  with regis.symbolizer.Symbolizer(_symbolizer_cache_dir()) as symbolizer:
+    symbolizer.symbolize_findings(findings)
+
+  unique_findings = regis.sanitizer_reports.dedupe(findings)
+  regis.diagnostics.log_err(f"{len(unique_findings)} unique sanitizer findings in {project} ({len(findings)} in total)")
+  report = []
+  for signature, same_findings in unique_findings.items():
+    regis.diagnostics.log_err(f"found {len(same_findings)} time(s):")
+    regis.diagnostics.log_no_color(same_findings[0].to_string())
+    finding_dict = same_findings[0].to_dict()
+    finding_dict["count"] = len(same_findings)
+    finding_dict["log_paths"] = [finding.log_path for finding in same_findings]
+    report.append(finding_dict)
+
+  report_path = os.path.join(root_path, settings["intermediate_folder"], settings["logs_folder"], sanitizer_logs_dir, f"{project}_findings.json")
+  regis.rex_json.save_file(report_path, report)
+  regis.diagnostics.log_err(f"sanitizer findings saved to {report_path}")
+
 # ---------------------------------------------
 # Code Analysis jobs
 # ---------------------------------------------
 
+class _IwyuTask():
+  """Include-what-you-use run over a single translation unit"""
+  def __init__(self, file : str, directory : str, invocation : list[str], logPath : str, expectedDuration : float, expectedMemory : int):
+    self.file = file
+    self.directory = directory
+    self.invocation = invocation
+    self.log_path = logPath
+    self.expected_duration = expectedDuration
+    self.expected_memory = expectedMemory
+    self.duration = None
+    self.peak_memory = None
+    self.cached = False
+
+def _iwyu_history_path(compdbFolder):
+  return os.path.join(compdbFolder, "iwyu_history.json")
+
+def _hash_file(path : str, fileHashes : dict[str, str]):
+  """Return the sha1 of a file's content, files are only hashed once per run"""
+  if path not in fileHashes:
+    hasher = hashlib.sha1()
+    with open(path, "rb") as f:
+      for chunk in iter(lambda: f.read(1 << 16), b''):
+        hasher.update(chunk)
+    fileHashes[path] = hasher.hexdigest()
+
+  return fileHashes[path]
+
+def _iwyu_version(iwyuPath : str, fileHashes : dict[str, str]):
+  """The version of include-what-you-use, the hash of its binary is used if it can't tell"""
+  try:
+    proc = subprocess.run([iwyuPath, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    version = proc.stdout.decode('utf-8', errors='replace').strip()
+    if proc.returncode == 0 and version:
+      return version
+  except OSError:
+    pass
+
+  return _hash_file(iwyuPath, fileHashes) if os.path.exists(iwyuPath) else ""
+
+def _iwyu_cache_key(entry : regis.compiler_db.CompileDBEntry, invocation : list[str], impPath : str, iwyuVersion : str, scanner : regis.compiler_db.IncludeScanner, fileHashes : dict[str, str]):
+  """The output of include-what-you-use only changes if the translation unit, the headers it includes,
+  the compile command, the mapping file or include-what-you-use itself changes, so that's what the cached output is keyed on"""
+  hasher = hashlib.sha1()
+  hasher.update(iwyuVersion.encode('utf-8'))
+  hasher.update(" ".join(invocation).encode('utf-8'))
+  hasher.update(entry.directory.encode('utf-8'))
+  hasher.update(_hash_file(entry.file, fileHashes).encode('utf-8'))
+  for header in sorted(scanner.find_includes(entry.file, entry.include_dirs())):
+    hasher.update(header.encode('utf-8'))
+    hasher.update(_hash_file(header, fileHashes).encode('utf-8'))
+
+  if impPath != "" and os.path.exists(impPath):
+    hasher.update(_hash_file(impPath, fileHashes).encode('utf-8'))
+
+  return hasher.hexdigest()
+
+def _create_iwyu_tasks(iwyuPath : str, iwyuVersion : str, compdbFolder : str, impPath : str, cacheFolder : str, scanner : regis.compiler_db.IncludeScanner, fileHashes : dict[str, str]):
+  """Create the include-what-you-use tasks for all translation units of a compiler db"""
+  history = {}
+  if os.path.exists(_iwyu_history_path(compdbFolder)):
+    history = regis.rex_json.load_file(_iwyu_history_path(compdbFolder)) or {}
+
+  tasks : list[_IwyuTask] = []
+  compdb = regis.compiler_db.CompileDB(compdbFolder)
+  for entry in compdb.entries:
+    # same as iwyu_tool.py, replace the compiler with include-what-you-use
+    args = entry.arguments()
+    invocation = [iwyuPath]
+    if Path(args[0]).stem.lower() in ["cl", "clang-cl"]:
+      invocation.append("--driver-mode=cl")
+    invocation.extend(args[1:])
+    invocation.extend(["-Xiwyu", "--quoted_includes_first"])
+
+    if impPath != "" and os.path.exists(impPath):
+      invocation.extend(["-Xiwyu", f"--mapping_file={impPath}"])
+
+    # the output of every translation unit is saved in the cache
+    # so it can be reused as long as nothing it depends on changes
+    cache_key = _iwyu_cache_key(entry, invocation, impPath, iwyuVersion, scanner, fileHashes)
+    log_path = os.path.join(cacheFolder, f"{cache_key}.log")
+
+    file_history = history.get(entry.file, {})
+    expected_duration = file_history.get('duration', float('inf'))
+    expected_memory = file_history.get('peak_memory') or 0
+    task = _IwyuTask(entry.file, entry.directory, invocation, log_path, expected_duration, expected_memory)
+    task.cached = os.path.exists(log_path)
+    if task.cached:
+      task.duration = file_history.get('duration')
+      task.peak_memory = file_history.get('peak_memory')
+    tasks.append(task)
+
+  return tasks
+
+def _merge_iwyu_outputs(outputFiles : list[str], mergedPath : str):
+  """Merge the include-what-you-use output of different configs into a single file.
+  The output is streamed block by block, every block holds the recommendations for a single file
+  and identical blocks produced by different configs are only written once"""
+  written_blocks = set()
+  with open(mergedPath, "w") as merged_file:
+    def _write_block(block : list[str]):
+      block_hash = hashlib.sha1("".join(block).encode('utf-8')).hexdigest()
+      if block_hash not in written_blocks:
+        written_blocks.add(block_hash)
+        merged_file.writelines(block)
+
+    for output_file in outputFiles:
+      if not os.path.exists(output_file):
+        continue
+
+      block : list[str] = []
+      with open(output_file, "r") as f:
+        for line in f:
+          block.append(line)
+          # include-what-you-use ends the recommendations of a file with a '---' line
+          if line.rstrip() == "---":
+            _write_block(block)
+            block = []
+
+      if len(block) > 0:
+        _write_block(block)
+
+def _save_iwyu_history(compdbFolder : str, tasks : list[_IwyuTask]):
+  """Save how long each translation unit took and how much memory it used, used to schedule the next run"""
+  history = {}
+  for task in tasks:
+    if task.duration is not None:
+      history[task.file] = { 'duration': task.duration, 'peak_memory': task.peak_memory }
+
+  regis.rex_json.save_file(_iwyu_history_path(compdbFolder), history)
+
 class IncludeWhatYouUseJob():
   """A job that runs include-what-you-use over a project"""
   def __init__(self, shouldClean : bool, fixIncludes : bool):
@@ -244,30 +580,65 @@ class IncludeWhatYouUseJob():
   
   def _run(self, singleThreaded : bool):
     """Run include what you use on the codebase"""
-    def _run(iwyuPath, compdb, outputPath, impPath, lock):
-      """Run the actual include-what-you-use command and save the output into a log file"""
-      # create the command line to launch include-what-you-use
-      cmd = ""
-      cmd += f"py {iwyuPath} -v -p={compdb}"
-      cmd += f" -- -Xiwyu --quoted_includes_first"
-      
-      if impPath != "" and os.path.exists(impPath):
-        cmd += f" -Xiwyu --mapping_file={impPath}"
-
-      # run include-what-you-use and save the output into a file
-      output = subprocess.getoutput(cmd)
-      with open(outputPath, "w") as f:
-        f.write(output)
-      output_lines = output.split('\n')
-
-      # print the output using our color coding
-      # to detect if it's an error, warning or regular log
-      with lock:
-        for line in output_lines:
-          _symbolic_print(line)
-
-        # log to the user that output has been saved
-        regis.diagnostics.log_info(f"include what you use info saved to {outputPath}")
+    def _run(tasks : list, lock, memoryMonitor : regis.memory_monitor.MemoryMonitor):
+      """Take translation units from the task list and run include-what-you-use on them.
+      The output is saved to the log file of the translation unit and printed as it comes in"""
+      while True:
+        task, slot = memoryMonitor.take(tasks, lambda task: task.expected_memory)
+        if task is None:
+          return
+
+        # translation units with the same cache key can run at the same time, so each run gets its own temp file
+        start_time = time.time()
+        last_line = ""
+        tmp_handle, tmp_log_path = tempfile.mkstemp(suffix=".tmp", dir=Path(task.log_path).parent)
+        with os.fdopen(tmp_handle, "w") as f:
+          try:
+            proc = subprocess.Popen(task.invocation, cwd=task.directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            slot.attach(proc.pid)
+
+            for line in iter(proc.stdout.readline, b''):
+              new_line : str = line.decode('UTF-8', errors='replace').rstrip('\r\n')
+              f.write(f"{new_line}\n")
+              if new_line.strip():
+                last_line = new_line.strip()
+
+              # print the output using our color coding
+              # to detect if it's an error, warning or regular log
+              with lock:
+                _symbolic_print(new_line)
+
+            proc.wait()
+          except Exception as ex:
+            with lock:
+              regis.diagnostics.log_err(f"failed to run include-what-you-use on {task.file}: {ex}")
+            memoryMonitor.release(slot)
+            failed = True
+          else:
+            failed = False
+
+        if failed:
+          os.remove(tmp_log_path)
+          continue
+
+        task.duration = time.time() - start_time
+        task.peak_memory = memoryMonitor.release(slot)
+
+        # a process that exited before its memory got sampled keeps the peak of last time, if there is one
+        if task.peak_memory is None:
+          task.peak_memory = task.expected_memory or None
+
+        # a process that got killed didn't produce the full output, so it can't be cached.
+        # the return code doesn't tell on every platform (eg. a terminated process exits with 1 on Windows)
+        # so the output itself needs to be complete: include-what-you-use ends the output of the translation unit
+        # with either the '---' line closing its recommendations or the line saying it has correct includes
+        finished = proc.returncode >= 0 and (last_line == "---" or last_line.endswith("has correct #includes/fwd-decls)"))
+        if finished:
+          os.replace(tmp_log_path, task.log_path)
+        else:
+          os.remove(tmp_log_path)
+          with lock:
+            regis.diagnostics.log_err(f"include-what-you-use didn't finish processing {task.file}, its output won't be cached")
   
     with regis.task_raii_printing.TaskRaiiPrint("running include-what-you-use"):
       # find all the compiler dbs.
@@ -275,14 +646,24 @@ class IncludeWhatYouUseJob():
       intermediate_folder = os.path.join(root_path, settings["intermediate_folder"], settings["build_folder"], iwyu_intermediate_dir)
       result = regis.util.find_all_files_in_folder(intermediate_folder, "compile_commands.json")
         
-      threads : list[threading.Thread] = []
       output_files_per_project : dict[str, list] = {}
+      tasks_per_output_file : dict[str, list[_IwyuTask]] = {}
+      tasks : list[_IwyuTask] = []
       lock = threading.Lock()
+      memory_monitor = regis.memory_monitor.MemoryMonitor()
+
+      # the cache lives next to the intermediate directory, so cleaning the intermediates doesn't throw it away
+      # its entries are keyed on the content of their inputs, so they never go stale
+      cache_folder = os.path.join(root_path, settings["intermediate_folder"], settings["build_folder"], iwyu_cache_dir)
+      if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+      scanner = regis.compiler_db.IncludeScanner()
+      file_hashes : dict[str, str] = {}
 
       iwyu_path = tool_paths_dict["include_what_you_use_path"]
-      iwyu_tool_path = os.path.join(Path(iwyu_path).parent, "iwyu_tool.py")
+      iwyu_version = _iwyu_version(iwyu_path, file_hashes)
 
-      # create the include-what-you-use jobs
+      # create an include-what-you-use task for every translation unit of every compiler db
       for compiler_db in result:
         compiler_db_folder = Path(compiler_db).parent
         impPath = os.path.join(compiler_db_folder, "iwyu.imp")
@@ -295,76 +676,108 @@ class IncludeWhatYouUseJob():
 
         output_files_per_project[project_name].append(output_path)
 
-        thread = threading.Thread(target=_run, args=(iwyu_tool_path, compiler_db, output_path, impPath, lock))
-        thread.start()
+        compdb_tasks = _create_iwyu_tasks(iwyu_path, iwyu_version, compiler_db_folder, impPath, cache_folder, scanner, file_hashes)
+        tasks_per_output_file[output_path] = compdb_tasks
+        tasks.extend([task for task in compdb_tasks if not task.cached])
 
-        # very simple way of splitting single threaded with multi threaded mode
-        # if we're single thread, we create a thread and immediately join it
-        # if we're using multi threaded mode, we join them after all of them have been created
-        if singleThreaded:
-          thread.join() 
-        else:
-          threads.append(thread)
+      num_cached_tasks = sum([len(compdb_tasks) for compdb_tasks in tasks_per_output_file.values()]) - len(tasks)
+      regis.diagnostics.log_info(f"reusing the include-what-you-use results of {num_cached_tasks} unchanged translation units")
+
+      # all translation units share a bounded pool of workers
+      # the translation units that took the longest last time are scheduled first
+      # a new one is only launched if there's enough memory available for it
+      tasks.sort(key=lambda task: task.expected_duration, reverse=True)
+      threads_to_use = 1 if singleThreaded else os.cpu_count()
+      threads : list[threading.Thread] = []
+      for _ in range(min(threads_to_use, len(tasks))):
+        thread = threading.Thread(target=_run, args=(tasks, lock, memory_monitor))
+        thread.start()
+        threads.append(thread)
 
-      # join all the threads after they've all been created
-      # this is basically a no op if we're running in single threaded mode
       for thread in threads:
         thread.join()
 
       threads.clear()
 
+      # fix_includes expects the output of a whole compiler db in a single file
+      used_cache_files = set()
+      for output_path, compdb_tasks in tasks_per_output_file.items():
+        with open(output_path, "w") as output_file:
+          for task in compdb_tasks:
+            if not os.path.exists(task.log_path):
+              continue
+            used_cache_files.add(Path(task.log_path).name)
+            with open(task.log_path, "r") as log_file:
+              shutil.copyfileobj(log_file, output_file)
+
+        _save_iwyu_history(Path(output_path).parent, compdb_tasks)
+
+        # log to the user that output has been saved
+        regis.diagnostics.log_info(f"include what you use info saved to {output_path}")
+
+      # remove the results of translation units that no longer exist in this form
+      for cache_file in os.listdir(cache_folder):
+        if cache_file not in used_cache_files:
+          os.remove(os.path.join(cache_folder, cache_file))
+
       # because different configs could require different symbols or includes
       # we need to process all configs first, then process each output file for each config
       # for a given project and only if an include is not needed in all configs
       # take action and remove it or replace it with a forward declare
-      # this can't be multithreaded
       if self.fix_includes:
         regis.diagnostics.log_info(f'Applying fixes..')
 
       fix_includes_path = os.path.join(Path(iwyu_path).parent, "fix_includes.py")
 
-      # this is the actual run in trying to fix the includes
-      # however it can be faked when self.fix_includes is false
-      # if so, it'll do a dry run without changing anything
-      # it'll still return a proper return code
-      # indicating if anything needs to be changed
-      rc = 0
-      for key in output_files_per_project.keys():
-        output_files = output_files_per_project[key]
-        lines = []
-        regis.diagnostics.log_info(f'processing: {key}')
-
+      def _process_project(project : str):
+        """Merge the include-what-you-use output of all configs of a project and pass it to fix_includes"""
         # include-what-you-use uses the output path of iwyu to determine what needs to be fixed
         # we merge all the outputs of all runs of iwyu on a project in different configs
         # and pass that temporary file over to include what you use
-        for file in output_files:
-          f = open(file, "r")
-          lines.extend(f.readlines())
+        filepath = os.path.join(intermediate_folder, f'{project}_tmp.iwyu')
+        _merge_iwyu_outputs(output_files_per_project[project], filepath)
+
+        # this is the actual run in trying to fix the includes
+        # however it can be faked when self.fix_includes is false
+        # if so, it'll do a dry run without changing anything
+        # it'll still return a proper return code
+        # indicating if anything needs to be changed
+        cmd = [sys.executable, fix_includes_path, '--noreorder', f'--process_merged={filepath}', '--nocomments', '--nosafe_headers']
+        if self.fix_includes == False:
+          cmd.append('--dry_run')
 
-        filename = f'{key}_tmp.iwyu'
-        filepath = os.path.join(intermediate_folder, filename)
-        f = open(filepath, "w")
-        f.writelines(lines)
-        f.close()
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-        # create the fix includes command line
-        cmd = f"py {fix_includes_path} --noreorder --process_merged=\"{filepath}\" --nocomments --nosafe_headers"
+        # the output of a project is printed in one go, so it doesn't interleave with other projects
+        with lock:
+          regis.diagnostics.log_info(f'processing: {project}')
+          regis.diagnostics.log_no_color(proc.stdout.decode('UTF-8', errors='replace'))
 
-        if self.fix_includes == False:
-          cmd += f" --dry_run"
+        return proc.returncode
+
+      # dry runs only read the sources so all projects can be processed at the same time
+      # applying fixes isn't, as projects can share headers which can't be written to at the same time
+      rc = 0
+      projects = list(output_files_per_project.keys())
+      if self.fix_includes or singleThreaded or len(projects) <= 1:
+        return_codes = [_process_project(project) for project in projects]
+      else:
+        with ThreadPool(min(len(projects), os.cpu_count())) as pool:
+          return_codes = pool.map(_process_project, projects)
 
-        # run the fix includes command line
-        rc |= os.system(f"{cmd}")  
+      for project_rc in return_codes:
+        rc |= project_rc
 
       return rc
 
 class ClangTidyJob():
   """A job that runs clang-tidy over a project"""
-  def __init__(self, shouldClean : bool, autoFix : bool, filterLines : bool, filesRegex : str):
+  def __init__(self, shouldClean : bool, autoFix : bool, filterLines : bool, filesRegex : str, diffBase : str = None):
     self.should_clean = shouldClean
     self.auto_fix = autoFix
     self.filter_lines = filterLines
     self.files_regex = filesRegex
+    self.diff_base = diffBase
     return
   
   def execute(self, singleThreaded : bool):
@@ -390,29 +803,32 @@ class ClangTidyJob():
     
   def _run(self, filterLines : bool, singleThreaded : bool):
     """Run clang-tidy on the codebase"""
-    rc = [0]
-    def _run(cmd : str, rc : int):
-      """Run the actual clang-tidy command"""
-      regis.diagnostics.log_info(f"executing: {cmd}")
-      proc = regis.util.run_subprocess_with_callback(cmd, _default_output_callback, filterLines)
-      new_rc = regis.util.wait_for_process(proc)
-      if new_rc != 0:
-        regis.diagnostics.log_err(f"clang-tidy failed for {compiler_db}")
-        regis.diagnostics.log_err(f"config file: {config_file_path}")
-      rc[0] |= new_rc
+    def _create_output_callback(outputPath : str):
+      """Create a callback that prints the clang-tidy output of a compiler db and saves it into a log file"""
+      if os.path.exists(outputPath):
+        os.remove(outputPath)
+
+      def _output_callback(invocation : list[str], output : str, err : str):
+        with open(outputPath, "a+") as f:
+          for line in (output + err).splitlines():
+            _symbolic_print(line, filterLines)
+            f.write(f"{line}\n")
+
+      return _output_callback
 
     with regis.task_raii_printing.TaskRaiiPrint("running clang-tidy"):
 
       # get the compiler dbs that are just generated
       result = _find_files(_create_full_intermediate_dir(clang_tidy_intermediate_dir), lambda file: 'compile_commands.json' in file)
 
-      # create the clang-tidy jobs, we limit ourselves to 5 threads at the moment as running clang-tidy is quite performance heavy
-      threads : list[threading.Thread] = []
-      threads_to_use = 5
-      script_path = os.path.dirname(__file__)
+      # all compiler dbs share a single pool of clang-tidy processes, sized to the number of cores
+      # in single threaded mode, we only run 1 clang-tidy process at a time
+      threads_to_use = 1 if singleThreaded else os.cpu_count()
       clang_tidy_path = tool_paths_dict["clang_tidy_path"]
       clang_apply_replacements_path = tool_paths_dict["clang_apply_replacements_path"]
 
+      rc = 0
+      runs : list[regis.run_clang_tidy.CompileDbRun] = []
       for compiler_db in result:
         compiler_db_folder = Path(compiler_db).parent
         config_file_path = f"{compiler_db_folder}/.clang-tidy_second_pass"
@@ -421,41 +837,43 @@ class ClangTidyJob():
         header_filters = regis.util.retrieve_header_filters(compiler_db_folder, project_name)
         header_filters_regex = regis.util.create_header_filter_regex(header_filters)
         
-        # build up the clang-tidy command
-        cmd = f"py \"{script_path}/run_clang_tidy.py\""
-        cmd += f" -clang-tidy-binary=\"{clang_tidy_path}\""  # location of clang-tidy executable
-        cmd += f" -clang-apply-replacements-binary=\"{clang_apply_replacements_path}\"" # location of clang-apply-replacements executable
-        cmd += f" -config-file=\"{config_file_path}\"" # location of clang-tidy config file
-        cmd += f" -p=\"{compiler_db_folder}\"" # location of compiler db folder (not the location to the file, but to its parent folder)
-        cmd += f" -header-filter={header_filters_regex}" # only care about headers of the current project
-        cmd += f" -quiet" # we don't want extensive logging
-        cmd += f" -j={threads_to_use}" # only use a certain amount of threads, to reduce the performance overhead
-
-        # auto fix found issues. This doesn't work for every enabled check.
-        if self.auto_fix:
-          cmd += f" -fix"
-
-        # add the regex of the files we care about
-        cmd += f" {self.files_regex}"
-
-        # perform an incremental run, avoid rescanning previous scanned files that didn't change (ignores cpp files if their headers changed)
-        if not self.should_clean:
-          cmd += f" -incremental"
-
-        # dirty hack to enable single thread mode vs multi threaded mode
-        # in single threaded mode, we join the threads immediately
-        thread = threading.Thread(target=_run, args=(cmd,rc,))
-        thread.start()
-
-        if singleThreaded:
-          thread.join()
-        else:
-          threads.append(thread)
+        # build up the clang-tidy options
+        options = regis.run_clang_tidy.TidyOptions(
+          buildPath=str(compiler_db_folder), # location of compiler db folder (not the location to the file, but to its parent folder)
+          clangTidyBinary=clang_tidy_path, # location of clang-tidy executable
+          clangApplyReplacementsBinary=clang_apply_replacements_path, # location of clang-apply-replacements executable
+          configFile=config_file_path, # location of clang-tidy config file
+          headerFilter=header_filters_regex, # only care about headers of the current project
+          quiet=True, # we don't want extensive logging
+          fix=self.auto_fix, # auto fix found issues. This doesn't work for every enabled check.
+          files=[self.files_regex], # the regex of the files we care about
+          incremental=not self.should_clean, # perform an incremental run, avoid rescanning previous scanned files that didn't change (ignores cpp files if their headers changed)
+          diffBase=self.diff_base, # only check the lines that changed compared to this git revision, if any
+          batch=True) # process files sharing a compile command in a single clang-tidy process, to save on startup cost
+
+        regis.diagnostics.log_info(f"preparing clang-tidy for {compiler_db}")
+        run = regis.run_clang_tidy.prepare_run(options)
+        if run is None:
+          regis.diagnostics.log_err(f"clang-tidy failed for {compiler_db}")
+          regis.diagnostics.log_err(f"config file: {config_file_path}")
+          rc |= 1
+          continue
+
+        run.output_callback = _create_output_callback(os.path.join(compiler_db_folder, "clang_tidy_output.log"))
+        runs.append(run)
+
+      # run clang-tidy over the files of all compiler dbs
+      # the files that took the longest on the previous run get scheduled first
+      regis.run_clang_tidy.schedule(runs, threads_to_use)
+
+      for run in runs:
+        new_rc = regis.run_clang_tidy.finish_run(run).return_code
+        if new_rc != 0:
+          regis.diagnostics.log_err(f"clang-tidy failed for {run.build_path}")
+          regis.diagnostics.log_err(f"config file: {run.args.config_file}")
+        rc |= new_rc
 
-      for thread in threads:
-        thread.join()
-
-      return rc[0]
+      return rc
 
 # ---------------------------------------------
 # Unit Tests
@@ -465,7 +883,9 @@ class ClangTidyJob():
 #
 class UnitTestJob():
   """A job that runs unit test projects"""
-  def __init__(self, projects : list[str], shouldClean : bool, enableAsan : bool, enableUbsan : bool, enableCodeCoverage : bool):
+  def __init__(self, projects : list[str], shouldClean : bool, enableAsan : bool, enableUbsan : bool, enableCodeCoverage : bool, coverageDiffBase : str = None, verbose : bool = False):
+    self.coverage_diff_base = coverageDiffBase
+    self.verbose = verbose
     self.projects = projects
     self.enable_asan = enableAsan
     self.enable_ubsan = enableUbsan
@@ -514,6 +934,7 @@ class UnitTestJob():
 
     # Now that we've build everything, let's run everything
     regis.diagnostics.log_no_color("-----------------------------------------------------------------------------")
+    _clear_runnable_output_logs()
     for project in self.projects:
       if project not in unit_test_projects:
         regis.diagnostics.log_err(f'project "{project}" not found in {test_projects_path}. Please check its generation settings')
@@ -525,7 +946,7 @@ class UnitTestJob():
       working_dir = project_settings['WorkingDir']
       
       # run all the tests
-      rc = self._run(runnables, working_dir)
+      rc = self._run(project, runnables, working_dir, singleThreaded)
       _pass_results[f"unit tests result - {project}"] = rc
 
     # Report any issues
@@ -562,20 +983,25 @@ class UnitTestJob():
     with regis.task_raii_printing.TaskRaiiPrint("building unit tests"):
       return _build_files(projects, singleThreaded)
   
-  def _run(self, runnables : list, workingDir : str):
+  def _run(self, project : str, runnables : list, workingDir : str, singleThreaded : bool):
     with regis.task_raii_printing.TaskRaiiPrint("running unit tests"):
       with regis.util.temp_cwd(workingDir):
         rc = 0
+        coverage_dir = _prepare_coverage_dir(project, unit_tests_intermediate_dir) if self.enable_code_coverage else None
     
-        # loop over each unit test program path and run it
-        for runnable_dict in runnables:
-          runnable = Runnable(runnable_dict, [], self.enable_asan, self.enable_ubsan)
-          new_rc = runnable.run()
+        # run all unit test programs, in parallel if possible
+        test_runnables = [Runnable(runnable_dict, [], self.enable_asan, self.enable_ubsan, coverage_dir, self.verbose) for runnable_dict in runnables]
+        return_codes = _run_runnables(test_runnables, singleThreaded)
 
+        for runnable, new_rc in zip(test_runnables, return_codes):
           if new_rc != 0:
             regis.diagnostics.log_err(f"unit test failed for {runnable.program}") # use full path to avoid ambiguity
           rc |= new_rc
 
+        _report_sanitizer_findings(project, test_runnables)
+        if self.enable_code_coverage:
+          rc |= _process_project_coverage(project, unit_tests_intermediate_dir, test_runnables, self.coverage_diff_base)
+
         return rc
 
 # ---------------------------------------------
@@ -587,7 +1013,9 @@ class UnitTestJob():
 
 class AutoTestJob():
   """A job that runs auto tests"""
-  def __init__(self, projects : list[str], timeoutInSeconds : int, shouldClean : bool, enableAsan : bool, enableUbsan : bool, enableCodeCoverage : bool):
+  def __init__(self, projects : list[str], timeoutInSeconds : int, shouldClean : bool, enableAsan : bool, enableUbsan : bool, enableCodeCoverage : bool, coverageDiffBase : str = None, verbose : bool = False):
+    self.coverage_diff_base = coverageDiffBase
+    self.verbose = verbose
     self.projects = projects
     self.enable_asan = enableAsan
     self.enable_ubsan = enableUbsan
@@ -637,6 +1065,7 @@ class AutoTestJob():
       return rc
     
     # Now that we've build everything, let's run everything
+    _clear_runnable_output_logs()
     for project in self.projects:
       if project not in auto_test_projects:
         regis.diagnostics.log_err(f'project "{project}" not found in {test_projects_path}. Please check its generation settings')
@@ -649,7 +1078,7 @@ class AutoTestJob():
       test_file = _find_tests_file(project_settings)
 
       # run all the tests
-      new_rc = self._run(runnables, working_dir, test_file, self.timeout_in_seconds)
+      new_rc = self._run(project, runnables, working_dir, test_file, self.timeout_in_seconds, singleThreaded)
       _pass_results[f'auto tests result - {project}'] = new_rc
 
       rc |= new_rc
@@ -686,40 +1115,35 @@ class AutoTestJob():
   def _build(self, projects : list[str], singleThreaded : bool):
     return _build_files(projects, singleThreaded)
   
-  def _run(self, runnables : list[str], workingDir : str, testFilePath : str, timeoutInSeconds : int):
+  def _run(self, project : str, runnables : list[str], workingDir : str, testFilePath : str, timeoutInSeconds : int, singleThreaded : bool):
     json_blob = regis.rex_json.load_file(testFilePath)
 
     with regis.task_raii_printing.TaskRaiiPrint("running auto tests"):
       with regis.util.temp_cwd(workingDir):
         rc = 0
+        coverage_dir = _prepare_coverage_dir(project, auto_test_intermediate_dir) if self.enable_code_coverage else None
 
+        # every test runs on every program, all of them can run in parallel
+        # a runnable that takes longer than the timeout gets terminated
+        test_runnables : list[Runnable] = []
         for test in json_blob:
           command_line : str = json_blob[test]["command_line"]
-          now = time.time()
-          max_seconds = timeoutInSeconds
-          def monitor_runnable(runnable : Runnable):
-            while not runnable.finished:
-              duration = time.time() - now
-              if duration > max_seconds:
-                runnable.terminate()
+          for runnable_dict in runnables:
+            test_runnables.append(Runnable(runnable_dict, command_line, self.enable_asan, self.enable_ubsan, coverage_dir, self.verbose))
 
-              time.sleep(1)
+        return_codes = _run_runnables(test_runnables, singleThreaded, timeoutInSeconds)
 
-          # loop over each unit test program path and run it
-          for runnable_dict in runnables:
-            runnable = Runnable(runnable_dict, command_line, self.enable_asan, self.enable_ubsan)
-            thread = threading.Thread(target=monitor_runnable, args=(runnable,))
-            thread.start()
-
-            new_rc = runnable.run()
-            thread.join()
-
-            if new_rc != 0:
-              if runnable.terminated:
-                regis.diagnostics.log_err(f"auto test timeout triggered for {runnable.program} after {max_seconds} seconds") # use full path to avoid ambiguity
-              else:
-                rc |= new_rc
-                regis.diagnostics.log_err(f"auto test failed for {runnable.program} with returncode {new_rc}") # use full path to avoid ambiguity
+        for runnable, new_rc in zip(test_runnables, return_codes):
+          if new_rc != 0:
+            if runnable.terminated:
+              regis.diagnostics.log_err(f"auto test timeout triggered for {runnable.program} after {timeoutInSeconds} seconds") # use full path to avoid ambiguity
+            else:
+              rc |= new_rc
+              regis.diagnostics.log_err(f"auto test failed for {runnable.program} with returncode {new_rc}") # use full path to avoid ambiguity
+
+        _report_sanitizer_findings(project, test_runnables)
+        if self.enable_code_coverage:
+          rc |= _process_project_coverage(project, auto_test_intermediate_dir, test_runnables, self.coverage_diff_base)
           
         return rc
   
@@ -732,7 +1156,10 @@ class AutoTestJob():
 
 class FuzzyTestJob():
   """A job that runs fuzzy tests"""
-  def __init__(self, projects : list[str], numRums : int, shouldClean : bool, enableAsan : bool, enableUbsan : bool, enableCodeCoverage : bool):
+  def __init__(self, projects : list[str], numRums : int, shouldClean : bool, enableAsan : bool, enableUbsan : bool, enableCodeCoverage : bool, coverageDiffBase : str = None, triageTimeBudget : int = 60, verbose : bool = False):
+    self.coverage_diff_base = coverageDiffBase
+    self.verbose = verbose
+    self.triage_time_budget = triageTimeBudget
     self.projects = projects
     self.enable_asan = enableAsan
     self.enable_ubsan = enableUbsan
@@ -781,6 +1208,7 @@ class FuzzyTestJob():
       return rc
 
     # Now that we've build everything, let's run everything
+    _clear_runnable_output_logs()
     for project in self.projects:
       if project not in fuzzy_test_projects:
         regis.diagnostics.log_err(f'project "{project}" not found in {test_projects_path}. Please check its generation settings')
@@ -792,7 +1220,7 @@ class FuzzyTestJob():
       working_dir = project_settings['WorkingDir']
 
       # run all the tests
-      new_rc = self._run(runnables, working_dir)
+      new_rc = self._run(project, runnables, working_dir, singleThreaded)
       _pass_results[f'fuzzy tests result - {project}'] = rc
 
       rc |= new_rc
@@ -828,27 +1256,82 @@ class FuzzyTestJob():
     with regis.task_raii_printing.TaskRaiiPrint("building unit tests"):
       return _build_files(projects, singleThreaded)
   
-  def _run(self, runnables : list, workingDir : str):
+  def _run(self, project : str, runnables : list, workingDir : str, singleThreaded : bool):
      with regis.task_raii_printing.TaskRaiiPrint("running unit tests"):
       with regis.util.temp_cwd(workingDir):
 
         rc = 0
+        coverage_dir = _prepare_coverage_dir(project, fuzzy_intermediate_dir) if self.enable_code_coverage else None
+
+        # the crash artifacts of the previous run have been triaged already
+        artifacts_dir = os.path.join(root_path, settings["intermediate_folder"], settings["build_folder"], fuzzy_artifacts_dir, project)
+        if os.path.exists(artifacts_dir):
+          shutil.rmtree(artifacts_dir)
     
-        # loop over each unit test program path and run it
-        for runnable_dict in runnables:
+        # every fuzzer runs on its own view of the shared corpus store
+        # a corpus in the working directory is imported into the store whenever it changed
+        corpus_store = regis.corpus_store.CorpusStore(_corpus_store_dir(), settings.get("fuzz_corpus_max_bytes", 1 << 30))
+
+        # run all fuzzy test programs, in parallel if possible
+        # the inputs they crash on are saved per runnable, instead of in the working directory
+        # the same program can be in the list more than once, so the index is part of the directory name
+        test_runnables : list[Runnable] = []
+        artifact_names : list[str] = []
+        for idx, runnable_dict in enumerate(runnables):
+          stem = Path(runnable_dict['Program']).stem
+          artifact_names.append(f"{stem}_{idx}")
+          program_artifacts_dir = os.path.join(artifacts_dir, artifact_names[-1])
+          os.makedirs(program_artifacts_dir, exist_ok=True)
+          corpus_store.import_dir(stem, 'corpus')
           args = []
-          args.append('corpus')
+          args.append(corpus_store.prepare_view(stem, artifact_names[-1]))
           args.append(f'-runs={self.num_runs}')
-          runnable = Runnable(runnable_dict, args, self.enable_asan, self.enable_ubsan)
-          new_rc = runnable.run()
+          args.append(f'-artifact_prefix={program_artifacts_dir}{os.sep}')
+          test_runnables.append(Runnable(runnable_dict, args, self.enable_asan, self.enable_ubsan, coverage_dir, self.verbose))
+
+        return_codes = _run_runnables(test_runnables, singleThreaded)
 
+        for runnable, artifact_name, new_rc in zip(test_runnables, artifact_names, return_codes):
           if new_rc != 0:
             regis.diagnostics.log_err(f"fuzzy testing failed for {runnable.program}") # use full path to avoid ambiguity
+            self._triage_crashes(runnable, artifacts_dir, artifact_name, singleThreaded)
 
           rc |= new_rc
 
+        self._update_corpus_store(corpus_store, test_runnables, artifact_names)
+        _report_sanitizer_findings(project, test_runnables)
+        if self.enable_code_coverage:
+          rc |= _process_project_coverage(project, fuzzy_intermediate_dir, test_runnables, self.coverage_diff_base)
+
         return rc
 
+  def _update_corpus_store(self, corpusStore : regis.corpus_store.CorpusStore, runnables : list[Runnable], viewNames : list[str]):
+    """Save the new inputs of the fuzzers in the store, distill their corpus once in a while and keep the store within its size"""
+    with regis.task_raii_printing.TaskRaiiPrint("updating fuzzy corpus store"):
+      distill_interval = settings.get("fuzz_corpus_distill_interval", 24 * 60 * 60)
+      for runnable, view_name in zip(runnables, viewNames):
+        stem = Path(runnable.program).stem
+        num_new = corpusStore.ingest_view(stem, view_name)
+        regis.diagnostics.log_info(f"{num_new} new input(s) found by {Path(runnable.program).name}")
+        if corpusStore.needs_distill(stem, distill_interval):
+          corpusStore.distill(stem, runnable.program)
+
+      corpusStore.evict()
+      corpusStore.save()
+
+  def _triage_crashes(self, runnable : Runnable, artifactsDir : str, artifactName : str, singleThreaded : bool):
+    """Group the crashes found by a fuzzer and minimize one input of every unique crash"""
+    with regis.task_raii_printing.TaskRaiiPrint(f"triaging crashes of {Path(runnable.program).name}"):
+      program_artifacts_dir = os.path.join(artifactsDir, artifactName)
+      with regis.symbolizer.Symbolizer(_symbolizer_cache_dir()) as symbolizer:
+        groups = regis.crash_triage.triage(runnable.program, program_artifacts_dir, os.path.join(program_artifacts_dir, "minimized"), self.triage_time_budget, symbolizer, 1 if singleThreaded else None)
+
+      if len(groups) == 0:
+        return
+
+      regis.diagnostics.log_err(f"{len(groups)} unique crash(es) found by {runnable.program}")
+      regis.crash_triage.save_report(groups, os.path.join(artifactsDir, f"{artifactName}_crashes.json"))
+
 # the compdbPath directory contains all the files needed to configure clang tools
 # this includes the compiler database, clang tidy config files, clang format config files
 # and a custom generated project file, which should have the same filename as the source root directory
@@ -914,22 +1397,36 @@ def test_include_what_you_use(shouldClean : bool = True, singleThreaded : bool =
   iwyu_job = IncludeWhatYouUseJob(shouldClean, shouldFix)
   return iwyu_job.execute(singleThreaded)
   
-def test_clang_tidy(filesRegex = ".*", shouldClean : bool = True, singleThreaded : bool = False, filterLines : bool = False, autoFix : bool = False):
-  clang_tidy_job = ClangTidyJob(shouldClean, autoFix, filterLines, filesRegex)
+def test_clang_tidy(filesRegex = ".*", shouldClean : bool = True, singleThreaded : bool = False, filterLines : bool = False, autoFix : bool = False, diffBase : str = None):
+  clang_tidy_job = ClangTidyJob(shouldClean, autoFix, filterLines, filesRegex, diffBase)
   return clang_tidy_job.execute(singleThreaded)
 
-def test_unit_tests(projects, shouldClean : bool = True, singleThreaded : bool = False, enableAsan : bool = False, enableUbsan : bool = False, enableCoverage : bool = False):
-  unit_test_job = UnitTestJob(projects, shouldClean, enableAsan, enableUbsan, enableCoverage)
+def test_unit_tests(projects, shouldClean : bool = True, singleThreaded : bool = False, enableAsan : bool = False, enableUbsan : bool = False, enableCoverage : bool = False, coverageDiffBase : str = None, verbose : bool = False):
+  unit_test_job = UnitTestJob(projects, shouldClean, enableAsan, enableUbsan, enableCoverage, coverageDiffBase, verbose)
   return unit_test_job.execute(singleThreaded)
 
-def test_fuzzy_testing(projects, numRuns, shouldClean : bool = True, singleThreaded : bool = False, enableAsan : bool = False, enableUbsan : bool = False, enableCodeCoverage : bool = False):
-  fuzzy_test_job = FuzzyTestJob(projects, numRuns, shouldClean, enableAsan, enableUbsan, enableCodeCoverage)
+def test_fuzzy_testing(projects, numRuns, shouldClean : bool = True, singleThreaded : bool = False, enableAsan : bool = False, enableUbsan : bool = False, enableCodeCoverage : bool = False, coverageDiffBase : str = None, crashTriageTimeBudget : int = 60, verbose : bool = False):
+  fuzzy_test_job = FuzzyTestJob(projects, numRuns, shouldClean, enableAsan, enableUbsan, enableCodeCoverage, coverageDiffBase, crashTriageTimeBudget, verbose)
   return fuzzy_test_job.execute(singleThreaded)
   
-def run_auto_tests(projects, timeoutInSeconds : int, shouldClean : bool = True, singleThreaded : bool = False, enableAsan : bool = False, enableUbsan : bool = False, enableCodeCoverage : bool = False):
-  auto_test_job = AutoTestJob(projects, timeoutInSeconds, shouldClean, enableAsan, enableUbsan, enableCodeCoverage)
+def run_auto_tests(projects, timeoutInSeconds : int, shouldClean : bool = True, singleThreaded : bool = False, enableAsan : bool = False, enableUbsan : bool = False, enableCodeCoverage : bool = False, coverageDiffBase : str = None, verbose : bool = False):
+  auto_test_job = AutoTestJob(projects, timeoutInSeconds, shouldClean, enableAsan, enableUbsan, enableCodeCoverage, coverageDiffBase, verbose)
   return auto_test_job.execute(singleThreaded)
 
+def test_combined_coverage(projects : list[str] = None, diffBase : str = None):
+  """Create a single coverage report and gate over the coverage of the last unit, auto and fuzzy test runs of the given projects.
+  If no projects are given, the coverage of all projects that ran with coverage enabled is combined.
+  If a diff base is given, only the coverage of the lines changed since then is checked"""
+  coverage_root = os.path.join(root_path, settings["intermediate_folder"], settings["build_folder"], coverage_intermediate_dir)
+  if not os.path.exists(coverage_root):
+    regis.diagnostics.log_warn(f'No coverage data found. have you run tests with coverage enabled?')
+    return 0
+
+  projects = projects or os.listdir(coverage_root)
+  rc = _process_coverage("combined_coverage", [coverage_dir for project in projects for coverage_dir in _get_coverage_dirs(project)], diffBase)
+  _pass_results["combined coverage"] = rc
+  return rc
+
 # Creating new projects
 class TestProjectType(Enum):
   UnitTest = 0,